@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+import os
+import mmap
+import math
+import array
+import struct
+import hashlib
+
+import Stats
+
+## A Bloom filter of the (digest, size) pairs of the files of a tree
+#  - Written by each fingerprint run of a tree to its .dp directory, so a
+#    lookup of a file the tree does not have is answered without reading the
+#    fingerprints of the tree, see Directory.checkFile. A file the filter
+#    might have is looked up as before.
+#  - The file is a header (magic, version, number of bits, number of hashes,
+#    number of keys, rollup of the root of the tree when the filter was
+#    written, length of the algorithms) followed by the bits and the digest
+#    algorithms of the tree, as "<scheme>=<algorithm>,...;..." where scheme
+#    is the algorithm new digests of the files are made with, see
+#    Hasher.algorithmFor. It is memory mapped, so a lookup only reads the
+#    pages of its bits.
+#  - The rollup tells if the tree changed since the filter was written, see
+#    DirStamp. A filter whose rollup is not the tree's is not used.
+#  - Positions are derived from two 32 bit hashes of the key (double hashing).
+class BloomFilter:
+    MAGIC = "DPBLOOM\0"
+    VERSION = 2
+    HEADER = struct.Struct("=8sIQIQ32sI")
+    FILE_NAME = "refFilter.bloom"
+
+    # share of the lookups of absent files that are let through
+    FALSE_POSITIVE_RATE = 0.01
+
+    ## Constructor
+    #  @param path - path to the filter file
+    def __init__(self, path):
+        self.path = path
+        self.__fh = open(path, "rb")
+        self.__map = mmap.mmap(self.__fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("=8sI", self.__map, 0)
+        if magic != BloomFilter.MAGIC or version != BloomFilter.VERSION:
+            self.close()
+            raise Exception("{} is not a usable filter".format(path))
+
+        magic, version, self.bits, self.hashes, self.count, self.rollup, n\
+            = BloomFilter.HEADER.unpack_from(self.__map, 0)
+        end = BloomFilter.HEADER.size + (self.bits + 7) // 8
+        if len(self.__map) != end + n:
+            self.close()
+            raise Exception("{} is not a usable filter".format(path))
+        self.rollup = self.rollup.rstrip("\0")
+
+        # scheme -> set of algorithms
+        self.algorithms = dict()
+        for entry in filter(None, self.__map[end:end + n].split(";")):
+            scheme, algorithms = entry.split("=", 1)
+            self.algorithms[scheme] = set(algorithms.split(","))
+
+    def close(self):
+        if self.__map != None:
+            self.__map.close()
+            self.__fh.close()
+            self.__map = None
+
+    ## This function returns the two hashes of a file's key
+    @staticmethod
+    def keyHashes(md5, size):
+        return struct.unpack_from("=II", hashlib.md5("{}|{}".format(md5, size)).digest())
+
+    @staticmethod
+    def __positions(h1, h2, bits, hashes):
+        return ((h1 + i * h2) % bits for i in xrange(hashes))
+
+    ## This function checks if a file with the given digest and size may be
+    #  in the tree
+    #  @return False if it is certainly not in the tree
+    def mightContain(self, md5, size):
+        h1, h2 = BloomFilter.keyHashes(md5, size)
+        for p in BloomFilter.__positions(h1, h2, self.bits, self.hashes):
+            if not ord(self.__map[BloomFilter.HEADER.size + (p >> 3)]) & (1 << (p & 7)):
+                return False
+        return True
+
+    ## This function writes a filter. The file is written next to path and
+    #  renamed over it once it is complete.
+    #  @param keys - array of the hashes of the keys, see keyHashes, two
+    #                items per key
+    #  @param rollup - rollup of the root of the tree
+    #  @param algorithms - dict of scheme -> set of algorithms, see above
+    @staticmethod
+    def write(path, keys, rollup, algorithms):
+        count = len(keys) // 2
+        bits = max(64, int(math.ceil(-count * math.log(BloomFilter.FALSE_POSITIVE_RATE)
+                                     / math.log(2) ** 2)))
+        hashes = max(1, int(round(bits * math.log(2) / max(count, 1))))
+
+        bitArray = bytearray((bits + 7) // 8)
+        for i in xrange(count):
+            for p in BloomFilter.__positions(keys[2 * i], keys[2 * i + 1], bits, hashes):
+                bitArray[p >> 3] |= 1 << (p & 7)
+        algorithms = ";".join("{}={}".format(scheme, ",".join(sorted(algos)))
+                              for scheme, algos in sorted(algorithms.iteritems()))
+
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as fh:
+            fh.write(BloomFilter.HEADER.pack(BloomFilter.MAGIC, BloomFilter.VERSION,
+                                             bits, hashes, count, rollup, len(algorithms)))
+            fh.write(bitArray)
+            fh.write(algorithms)
+            fh.flush()
+            os.fsync(fh.fileno())
+            Stats.count("fsyncs")
+        os.rename(tmpPath, path)
+        return bits
+
+    ## This function returns a new array to collect the hashes of keys in,
+    #  see add
+    @staticmethod
+    def newKeys():
+        return array.array("I")
+
+    ## This function adds the hashes of a file's key to an array of keys
+    @staticmethod
+    def add(keys, md5, size):
+        keys.extend(BloomFilter.keyHashes(md5, size))
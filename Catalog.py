@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+import os.path
+import sqlite3
+import time
+
+import Stats
+from Logger import Logger
+from Directory import Directory, Fingerprint
+
+## A catalog of the fingerprints of several reference trees (targets), e.g.
+#  backup drives
+#  - The fingerprints of every target are merged in one SQLite database,
+#    indexed by digest, so a single lookup tells on which targets a file is
+#    and where.
+#  - Targets are read from their fingerprint databases or index, so they have
+#    to be fingerprinted first. Updating a target only reads the directories
+#    whose stamp rollup or Merkle digest changed since the last update; the
+#    subtree of an unchanged directory is skipped.
+#  - A catalog can be used as the reference directory of Directory.removeDups
+#    and Directory.copyUniques. A file is found if its digest is on any target
+#    or, with requireAll, on every target.
+class Catalog:
+    ## Constructor
+    #  @param path - path to the catalog database. created if it does not exist
+    #  @param requireAll - checkFile only finds files that are on every target
+    def __init__(self, path, requireAll=False):
+        self.path = os.path.abspath(path)
+        self.requireAll = requireAll
+        logDir = self.path + ".logs"
+        if Logger.runLogFile == None and not Logger.toStdOut and not os.path.isdir(logDir):
+            os.makedirs(logDir)
+        self.logger = Logger(os.path.join(logDir, Logger.newLogFileName()), "catalog")
+
+        self.__conn = sqlite3.connect(self.path)
+        # file names are kept as byte strings
+        self.__conn.text_factory = str
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS targets ("
+                                "id INTEGER PRIMARY KEY, "
+                                "root TEXT UNIQUE NOT NULL, "
+                                "updated REAL)")
+            # rollup and merkle of each directory when it was last read
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS dirs ("
+                                "target INTEGER NOT NULL, "
+                                "dir TEXT NOT NULL, "
+                                "rollup TEXT NOT NULL, "
+                                "merkle TEXT NOT NULL, "
+                                "PRIMARY KEY (target, dir))")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                                "target INTEGER NOT NULL, "
+                                "dir TEXT NOT NULL, "
+                                "file TEXT NOT NULL, "
+                                "md5 TEXT NOT NULL, "
+                                "mtime BLOB NOT NULL, "
+                                "size INTEGER NOT NULL, "
+                                "PRIMARY KEY (target, dir, file))")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS filesByMd5 ON files (md5)")
+
+        self.__targets = dict(self.__conn.execute("SELECT id, root FROM targets"))
+
+    def close(self):
+        if self.__conn != None:
+            self.__conn.close()
+            self.__conn = None
+
+    ## This function returns the roots of the targets in the catalog
+    def getTargets(self):
+        return sorted(self.__targets.values())
+
+    ## This function adds a target to the catalog or brings it up to date
+    #  @param root - root directory of the target
+    #  @return number of directories read
+    def updateTarget(self, root):
+        root = os.path.abspath(root)
+        with self.__conn:
+            self.__conn.execute("INSERT OR IGNORE INTO targets (root) VALUES (?)", (root,))
+        target = self.__conn.execute("SELECT id FROM targets WHERE root = ?", (root,)).fetchone()[0]
+        self.__targets[target] = root
+        self.logger.info("updating catalog with {}...", root)
+
+        known = dict(((d, (rollup, merkle)) for d, rollup, merkle in
+                      self.__conn.execute("SELECT dir, rollup, merkle FROM dirs WHERE target = ?",
+                                          (target,))))
+        visited = set()
+        prunedDirs = []
+
+        # a directory whose entries and contents are unchanged has the same
+        # files in its subtree as when it was read
+        def prune(d):
+            relDir = os.path.relpath(d.path, root)
+            stamp = d.fpCache.stamp
+            if stamp != None and d.fpCache.merkle\
+                    and known.get(relDir) == (stamp.rollup, d.fpCache.merkle):
+                prunedDirs.append(relDir)
+                return True
+            return False
+
+        for d in Directory(root, True).walkPruned(prune):
+            relDir = os.path.relpath(d.path, root)
+            visited.add(relDir)
+            stamp = d.fpCache.stamp
+            with self.__conn:
+                self.__conn.execute("DELETE FROM files WHERE target = ? AND dir = ?", (target, relDir))
+                self.__conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                        ((target, relDir, fp.file, fp.md5, fp.mtime, fp.size)
+                                         for fp in d.fpCache.fpByFile.itervalues() if fp.md5))
+                self.__conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                                    (target, relDir, stamp.rollup if stamp != None else "",
+                                     d.fpCache.merkle))
+
+        # directories that are gone, i.e. not read and not in a pruned subtree
+        def isKept(relDir):
+            if relDir in visited:
+                return True
+            for p in prunedDirs:
+                if relDir == p or p == "." or relDir.startswith(p + os.sep):
+                    return True
+            return False
+
+        stale = [(target, d) for d in known.iterkeys() if not isKept(d)]
+        with self.__conn:
+            self.__conn.executemany("DELETE FROM files WHERE target = ? AND dir = ?", stale)
+            self.__conn.executemany("DELETE FROM dirs WHERE target = ? AND dir = ?", stale)
+            self.__conn.execute("UPDATE targets SET updated = ? WHERE id = ?", (time.time(), target))
+
+        self.logger.info("read {} directories, skipped {} unchanged subtrees, removed {} directories",
+                   len(visited), len(prunedDirs), len(stale))
+        return len(visited)
+
+    ## This function brings every target in the catalog up to date
+    def updateAll(self):
+        for root in self.getTargets():
+            if not os.path.isdir(root):
+                self.logger.info("{} is not mounted, skipping...", root)
+                continue
+            self.updateTarget(root)
+
+    def __find(self, md5, size):
+        return self.__conn.execute("SELECT target, dir, file, mtime FROM files "
+                                   "WHERE md5 = ? AND size = ? ORDER BY target",
+                                   (md5, size)).fetchall()
+
+    def __toFingerprint(self, row, md5, size):
+        target, dir, file, mtime = row
+        return Fingerprint(file, os.path.normpath(os.path.join(self.__targets[target], dir)),
+                           md5, mtime, size)
+
+    ## This function finds the copies of a file on the targets
+    #  @return list of Fingerprint, in target order
+    def lookup(self, md5, size):
+        return [self.__toFingerprint(row, md5, size) for row in self.__find(md5, size)]
+
+    ## This function returns the roots of the targets a file is on
+    def presentOn(self, md5, size):
+        return sorted(set(self.__targets[row[0]] for row in self.__find(md5, size)))
+
+    ## This function finds a copy of a file on the targets, on any target or,
+    #  with requireAll, on every target
+    #  @return Fingerprint of the copy on the first target, or None
+    def checkFile(self, fp):
+        Stats.count("lookups")
+        with Stats.Timer("lookup"):
+            rows = self.__find(fp.md5, fp.size)
+        if not rows:
+            return None
+        if self.requireAll and len(set(row[0] for row in rows)) < len(self.__targets):
+            return None
+
+        Stats.count("lookupHits")
+        return self.__toFingerprint(rows[0], fp.md5, fp.size)
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+import os
+import errno
+import shutil
+import collections
+import ctypes
+import ctypes.util
+
+from Hasher import HashPool
+import Stats
+
+# ioctl to clone the extents of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# bytes moved by each copy_file_range/sendfile call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# errors meaning that a way of copying is not supported for these files
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EPERM, errno.EBADF)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_libc = None
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+except OSError:
+    pass
+
+def _libcFunc(name, argtypes):
+    func = getattr(_libc, name, None) if _libc != None else None
+    if func != None:
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = argtypes
+    return func
+
+if hasattr(os, "copy_file_range"):
+    def _copyFileRange(src, dst, count):
+        return os.copy_file_range(src, dst, count)
+else:
+    _libcCopyFileRange = _libcFunc("copy_file_range",
+                                   [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                    ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+    def _copyFileRange(src, dst, count):
+        if _libcCopyFileRange == None:
+            raise OSError(errno.ENOSYS, "copy_file_range is not available")
+        n = _libcCopyFileRange(src, None, dst, None, count, 0)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+
+if hasattr(os, "sendfile"):
+    def _sendfile(src, dst, count):
+        return os.sendfile(dst, src, None, count)
+else:
+    _libcSendfile = _libcFunc("sendfile",
+                              [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    def _sendfile(src, dst, count):
+        if _libcSendfile == None:
+            raise OSError(errno.ENOSYS, "sendfile is not available")
+        n = _libcSendfile(dst, src, None, count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+
+def _reflink(src, dst, size):
+    if fcntl == None:
+        raise OSError(errno.ENOSYS, "ioctl is not available")
+    fcntl.ioctl(dst, FICLONE, src)
+
+## This function moves size bytes from src to dst with copy, one chunk per call
+def _copyLoop(copy):
+    def f(src, dst, size):
+        done = 0
+        while done < size:
+            n = copy(src, dst, min(CHUNK_SIZE, size - done))
+            if n == 0:
+                break
+            done += n
+    return f
+
+## Ways of copying a file in the kernel, fastest first. A way that turns out to
+#  be unsupported by the system is not tried again.
+_methods = [["reflink", _reflink],
+            ["copy_file_range", _copyLoop(_copyFileRange)],
+            ["sendfile", _copyLoop(_sendfile)]]
+
+## This function copies the content of src to dst, without moving the data
+#  through user space if the system allows it
+#  @return the name of the way the file was copied
+def _copyData(src, dst, size):
+    for method in _methods:
+        name, func = method
+        if func == None:
+            continue
+
+        try:
+            func(src.fileno(), dst.fileno(), size)
+            return name
+        except (OSError, IOError) as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            if e.errno == errno.ENOSYS:
+                method[1] = None
+            # nothing was copied by a failing method unless it failed
+            # part way through, so start over
+            dst.seek(0)
+            dst.truncate()
+            src.seek(0)
+
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return "read/write"
+
+## This function copies a file and its modify time
+#  @return stat of the copy
+def copyFile(srcFile, dstFile):
+    with Stats.Timer("copy"):
+        with open(srcFile, "rb") as src:
+            st = os.fstat(src.fileno())
+            with open(dstFile, "wb") as dst:
+                _copyData(src, dst, st.st_size)
+
+        os.utime(dstFile, (st.st_atime, st.st_mtime))
+        dstStat = os.stat(dstFile)
+
+    Stats.count("filesCopied")
+    Stats.count("bytesCopied", st.st_size)
+    return dstStat
+
+## This function makes dstFile a clone of srcFile that shares its data on disk
+#  (btrfs, xfs, ...). Fails with an IOError if the filesystem can not clone.
+def reflinkFile(srcFile, dstFile):
+    with open(srcFile, "rb") as src:
+        with open(dstFile, "wb") as dst:
+            _reflink(src.fileno(), dst.fileno(), 0)
+
+## A queue of file copies
+#  - Up to jobs files are copied concurrently on a HashPool.
+#  - Callbacks are called from the thread that submits the copies, in the
+#    order in which the copies were submitted, so they may update fingerprint
+#    caches.
+#  - At most 4*jobs copies are pending at a time.
+class Copier:
+    ## Constructor
+    #  @param jobs - number of files to copy concurrently
+    def __init__(self, jobs=1):
+        self.__pool = HashPool(jobs)
+        self.__window = 4 * jobs
+        self.__pending = collections.deque()
+
+    ## This function copies srcFile to dstFile
+    #  @param done - called with the stat of dstFile once the copy is done
+    def submit(self, srcFile, dstFile, done):
+        self.__pending.append((self.__pool.submit(copyFile, (srcFile, dstFile)), done))
+        while len(self.__pending) > self.__window:
+            self.__finishOne()
+
+    ## This function calls callback once all the copies submitted so far are
+    #  done
+    def then(self, callback):
+        self.__pending.append((None, callback))
+
+    def __finishOne(self):
+        result, done = self.__pending.popleft()
+        if result == None:
+            done()
+        else:
+            done(result.get())
+
+    ## This function waits for all the copies and calls their callbacks
+    def drain(self):
+        while self.__pending:
+            self.__finishOne()
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            self.__pool.close()
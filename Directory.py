@@ -1,7 +1,15 @@
 #!/usr/bin/python
 
 import os.path
+import sys
 import Logger
+import Hasher
+import Stats
+from FPIndex import FPIndex
+from IOScheduler import IOScheduler
+from DupPlan import DupPlan
+from BloomFilter import BloomFilter
+import Copier
 try:
     from os import scandir
 except ImportError:
@@ -9,81 +17,336 @@ except ImportError:
 
 from time import strftime, localtime
 import ntpath
-import hashlib
 from enum import IntEnum
 import pprint
-from shutil import copyfile
 import time
-
-class Fingerprint:
-    def __init__(self, file, dir, md5, mtime, size):
+import collections
+import hashlib
+import filecmp
+import shutil
+import errno
+
+## The fingerprint of a file
+#  Trees with millions of files keep millions of these in memory, so they
+#  have slots instead of a dict and the path is joined only when asked for;
+#  the fingerprints of a directory share its dir string.
+class Fingerprint(object):
+    __slots__ = ("file", "dir", "md5", "mtime", "size", "partial")
+
+    def __init__(self, file, dir, md5, mtime, size, partial=""):
         self.file = file
+        self.dir = dir
+        # md5 is empty for files that were not fully hashed because their size
+        # or partial digest is unique in the tree (see --size-prefilter)
         self.md5 = md5
+        # modify time in nanoseconds, or in seconds as a float for records
+        # written before nanosecond modify times, see sameMtime
         self.mtime = mtime
         self.size = size
-        # this is for processing purposes only. it is not persisted in FP DB
-        self.path = os.path.join(dir,file)
-
+        # digest of the head and tail of the file. empty if not computed.
+        self.partial = partial
+
+    # this is for processing purposes only. it is not persisted in FP DB
+    @property
+    def path(self):
+        return os.path.join(self.dir, self.file)
+
+## Summary of a directory's state when it was last fingerprinted
+#  - mtime and count are the modify time and the number of entries of the
+#    directory. They change when an entry is added, removed or renamed.
+#  - rollup is a digest of mtime, count and the rollups of the sub directories,
+#    so it changes when anything in the subtree is added, removed or renamed.
+class DirStamp:
+    def __init__(self, mtime, count, rollup):
+        self.mtime = mtime
+        self.count = count
+        self.rollup = rollup
+
+    def __eq__(self, other):
+        return other != None\
+                and self.mtime == other.mtime\
+                and self.count == other.count\
+                and self.rollup == other.rollup
+
+    def __ne__(self, other):
+        return not self == other
+
+## A cache of the fingerprints of the files in a directory
+#  - Fingerprints are stored in a fingerprint database file, one line per file:
+#    <file>|<digest>|<mtime>|<size>|<partial digest>
+#  - Digests are "<algorithm>:<hex digest>", or a plain hex digest for md5. So
+#    databases written before other algorithms were supported stay valid and
+#    digests can be upgraded to another algorithm one file at a time.
+#  - Lines starting with '/' hold information about the directory and the
+#    format version of the file (1 if there is no version line).
+#  - Modify times are in nanoseconds since version 3. Older records hold
+#    float seconds and are kept as floats, see sameMtime.
+#  - Changes are appended to a journal next to the database file, in the same
+#    format plus '/delete|<file>' lines, and fsynced once per flush. The
+#    journal is replayed over the database when it is read. Once the journal
+#    holds more records than the database, the database is rewritten to a
+#    temporary file that is renamed over it and the journal is removed.
+#  - Nothing is written unless flushCache is called.
 class FPCache:
-    def __init__(self, path, logger):
+    FORMAT_VERSION = 3
+
+    # a journal is compacted into the database once it has more records than
+    # this or than the database
+    JOURNAL_MIN_RECORDS = 1000
+
+    # checkpoint() flushes once this many fingerprints were changed or this
+    # many seconds have passed since the last flush
+    CHECKPOINT_RECORDS = 256
+    CHECKPOINT_SECONDS = 30
+
+    ## Constructor
+    #  @param path - fully qualified path to the fingerprint database file
+    #  @param index - FPIndex of the tree. If given, fingerprints are read from
+    #                 and written to the index instead of the file at path.
+    #  @param realDir - the directory the fingerprints are of, if the database
+    #                   is in a work directory elsewhere, see dropRefFilters
+    def __init__(self, path, logger, index=None, realDir=None):
         self.path = path
+        self.journalPath = os.path.splitext(path)[0] + ".journal"
         self.logger = logger
         self.dir = os.path.dirname(os.path.dirname(path))
+        self.realDir = realDir if realDir != None else self.dir
+        self.index = index
 
         self.fpByFile = dict()
         self.fpByMd5 = dict()
         self.deletedFiles = []
+        self.stamp = None
+        # digest of the contents of the directory's subtree, see Directory.__makeMerkle
+        self.merkle = ""
+
+        # files changed since the last flush
+        self.__changedFiles = set()
+        self.__journalRecords = 0
+        # a torn journal can not be appended to and is compacted on the next flush
+        self.__journalTorn = False
+        self.__lastFlush = time.time()
 
         self.__readDB()
         self.__cacheDirty = False
 
-    def __del__(self):
-        self.flushCache()
+    def __addRecord(self, file, md5, mtime, size, partial):
+        fp = Fingerprint(file, self.dir, md5, mtime, size, partial)
+
+        self.fpByFile[file] = fp
+        if fp.md5:
+            self.fpByMd5[md5] = fp
+
+    def __removeRecord(self, file):
+        fp = self.fpByFile.pop(file, None)
+        if fp != None and fp.md5 in self.fpByMd5 and self.fpByMd5[fp.md5] is fp:
+            del self.fpByMd5[fp.md5]
 
     def __readDB(self):
         self.logger.debug("reading fingerprint database...")
 
-        if not os.path.isfile(self.path):
+        if self.index != None:
+            for file, md5, mtime, size, partial in self.index.readDir(self.dir):
+                self.__addRecord(file, md5, mtime, long(size), partial)
+            stamp = self.index.readStamp(self.dir)
+            if stamp != None:
+                self.stamp = DirStamp(*stamp)
+            self.merkle = self.index.readMerkle(self.dir)
+            return
+
+        haveDB = os.path.isfile(self.path)
+        haveJournal = os.path.isfile(self.journalPath)
+        if not haveDB and not haveJournal:
             # there is nothing to read
             self.logger.warn("fingerprint database file not found")
             return
 
-        fh = open(self.path, 'r')
+        if haveDB:
+            self.__readFile(self.path)
+        if haveJournal:
+            self.__journalRecords = self.__readFile(self.journalPath)
+
+    ## This function reads a database or journal file into the cache
+    #  @return number of records read
+    def __readFile(self, path):
+        records = 0
+        fh = open(path, 'r')
         for line in fh:
+            if not line.endswith("\n"):
+                # the last record of a journal is torn if a flush was
+                # interrupted. the records before it are complete.
+                self.logger.warn("ignoring incomplete record at the end of {}".format(path))
+                self.__journalTorn = True
+                break
+
             line = line.rstrip()
             if not line:
                 continue
             vals = line.split('|')
+            records += 1
+
+            # file names can not contain '/', so such lines hold information
+            # about the directory itself
+            if vals[0] == "/format":
+                if int(vals[1]) > FPCache.FORMAT_VERSION:
+                    raise Exception("{} was written by a newer version of dup_finder"\
+                                    .format(path))
+                continue
+            elif vals[0] == "/stamp":
+                self.stamp = DirStamp(parseMtime(vals[1]), int(vals[2]), vals[3])
+                continue
+            elif vals[0] == "/merkle":
+                self.merkle = vals[1]
+                continue
+            elif vals[0] == "/delete":
+                self.__removeRecord(vals[1])
+                continue
 
-            fp = Fingerprint(vals[0],\
-                             self.dir,\
-                             vals[1],\
-                             float(vals[2]),\
-                             long(vals[3]))
+            # records written before partial digests were introduced have
+            # only 4 fields
+            partial = vals[4] if len(vals) > 4 else ""
+            # a journal may modify a file that is already in the cache
+            self.__removeRecord(vals[0])
+            self.__addRecord(vals[0], vals[1], parseMtime(vals[2]), long(vals[3]), partial)
 
-            self.fpByFile[vals[0]] = fp
-            self.fpByMd5[vals[1]] = fp
+        fh.close()
+        return records
 
-    def flushCache(self):
-        if not self.__cacheDirty:
-            return
+    def __writeHeader(self, fh):
+        fh.write("/format|{}\n".format(FPCache.FORMAT_VERSION))
+        if self.stamp != None:
+            fh.write("/stamp|{}|{}|{}\n"\
+                     .format(self.stamp.mtime, self.stamp.count, self.stamp.rollup))
+        fh.write("/merkle|{}\n".format(self.merkle))
+
+    @staticmethod
+    def __writeRecord(fh, fp):
+        fh.write("{}|{}|{}|{}|{}\n"\
+                 .format(fp.file, fp.md5, fp.mtime, fp.size, fp.partial))
 
-        self.logger.info("flushing fingerprints to file...")
-        fh = open(self.path, "w")
+    @staticmethod
+    def __sync(fh):
+        fh.flush()
+        with Stats.Timer("fsync"):
+            os.fsync(fh.fileno())
+        Stats.count("fsyncs")
+
+    ## This function rewrites the database file and removes the journal. The
+    #  new database is written to a temporary file that is renamed over the old
+    #  one, so the old database stays valid until the new one is complete.
+    def __writeDB(self):
+        # the .dp directory is not created up front if logs go to a run log
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        tmpPath = self.path + ".tmp"
+        fh = open(tmpPath, "w")
+        self.__writeHeader(fh)
         for f, fp in self.fpByFile.iteritems():
             if f in self.deletedFiles:
                 continue
 
-            fh.write("{}|{}|{}|{}\n"\
-                     .format(fp.file, fp.md5, fp.mtime, fp.size))
+            FPCache.__writeRecord(fh, fp)
 
+        FPCache.__sync(fh)
         fh.close()
+        os.rename(tmpPath, self.path)
+
+        if os.path.isfile(self.journalPath):
+            os.remove(self.journalPath)
+        self.__journalRecords = 0
+        self.__journalTorn = False
+
+    ## This function appends the changes since the last flush to the journal
+    def __appendJournal(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        fh = open(self.journalPath, "a")
+        self.__writeHeader(fh)
+        records = 2 if self.stamp == None else 3
+        for f in self.__changedFiles:
+            if f in self.fpByFile:
+                FPCache.__writeRecord(fh, self.fpByFile[f])
+            else:
+                fh.write("/delete|{}\n".format(f))
+            records += 1
+
+        FPCache.__sync(fh)
+        fh.close()
+        self.__journalRecords += records
+
+    def flushCache(self):
+        if not self.__cacheDirty:
+            return
+
+        if self.index != None:
+            self.logger.info("flushing fingerprints to index...")
+            self.index.writeDir(self.dir, [fp for f, fp in self.fpByFile.iteritems()\
+                                           if f not in self.deletedFiles],\
+                                self.stamp, self.merkle)
+        elif not os.path.isfile(self.path) or self.__journalTorn\
+                or self.__journalRecords + len(self.__changedFiles)\
+                   > max(FPCache.JOURNAL_MIN_RECORDS, len(self.fpByFile)):
+            self.logger.info("flushing fingerprints to file...")
+            self.__writeDB()
+        else:
+            self.logger.info("flushing fingerprints to journal...")
+            self.__appendJournal()
+
+        dropRefFilters(self.realDir)
 
         # also create deletedFiles variable
         self.deletedFiles = []
 
+        self.__changedFiles = set()
+        self.__lastFlush = time.time()
         self.__cacheDirty = False
 
+    ## This function flushes the cache if enough has changed since the last
+    #  flush. Long runs call it after every change so that an interrupted run
+    #  loses little work. An index rewrites the whole directory on each flush,
+    #  so it is only flushed on time.
+    def checkpoint(self):
+        if (self.index == None and len(self.__changedFiles) >= FPCache.CHECKPOINT_RECORDS)\
+                or (self.__cacheDirty\
+                    and time.time() - self.__lastFlush >= FPCache.CHECKPOINT_SECONDS):
+            self.flushCache()
+
+    ## This function records that a file's fingerprint changed. The Merkle
+    #  digest of the directory no longer holds until it is computed again.
+    def __setChanged(self, file):
+        self.__changedFiles.add(file)
+        self.merkle = ""
+        self.__cacheDirty = True
+
+    ## This function writes the fingerprints to the fingerprint database file,
+    #  even if the cache is backed by an index
+    def exportDB(self):
+        self.__writeDB()
+
+    def setStamp(self, stamp):
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.__cacheDirty = True
+
+    def setMerkle(self, merkle):
+        if merkle != self.merkle:
+            self.merkle = merkle
+            self.__cacheDirty = True
+
+    ## This function checks if every file in the cache has a full digest
+    #  @param current - the digests must also have been made with the
+    #                   algorithm new digests of the files would be made with,
+    #                   see Hasher.algorithmFor
+    def isComplete(self, current=False):
+        for fp in self.fpByFile.itervalues():
+            if not fp.md5:
+                return False
+            if current and Hasher.algorithmOf(fp.md5) != Hasher.algorithmFor(fp.size):
+                return False
+        return True
+
     def getFpForFile(self, file):
         if not self.fpByFile:
             return None
@@ -92,13 +355,16 @@ class FPCache:
         else:
             return None
 
-    def addFingerprint(self, file, md5, mtime, size):
+    ## This function adds or modifies the fingerprint of a file.
+    #  @param md5 - full digest of the file. Empty if the file was not hashed
+    #               in full. Such fingerprints are not indexed by digest.
+    #  @param partial - digest of the head and tail of the file, if computed
+    def addFingerprint(self, file, md5, mtime, size, partial=""):
         if file in self.fpByFile:
             # modify FP in fpByFile and then for dpByMd5, delete entry 
             # for old md5 and add it an
             # entry for new md5
-            self.logger.info("modifying {} with digest {} in cache..."\
-                             .format(file, md5))
+            self.logger.info("modifying {} with digest {} in cache...", file, md5)
 
             assert self.fpByFile[file].file == file
             # record old FP
@@ -107,27 +373,30 @@ class FPCache:
             self.fpByFile[file].md5 = md5
             self.fpByFile[file].mtime = mtime
             self.fpByFile[file].size = size
+            self.fpByFile[file].partial = partial
 
             # add by new fingerprint
-            del self.fpByMd5[oldFp]
-            self.fpByMd5[md5] = self.fpByFile[file]
+            if oldFp in self.fpByMd5 and self.fpByMd5[oldFp] is self.fpByFile[file]:
+                del self.fpByMd5[oldFp]
+            if md5:
+                self.fpByMd5[md5] = self.fpByFile[file]
         else:
 
             # this assert should not fire unless there are duplicates in 
             # the same directory
-            if  md5 in self.fpByMd5:
+            if md5 and md5 in self.fpByMd5:
                 self.logger.warn("{} is same as {} in {}"\
                     .format(file, self.fpByMd5[md5].file,self.dir))
 
             # we need to create a new fingerprint and add to dictionaries
-            self.logger.info("adding file {} with digest {} to cache..."\
-                .format(file, md5))
-            fp = Fingerprint(file, self.dir, md5, float(mtime), long(size))
+            self.logger.info("adding file {} with digest {} to cache...", file, md5)
+            fp = Fingerprint(file, self.dir, md5, mtime, long(size), partial)
 
             self.fpByFile[file] = fp
-            self.fpByMd5[md5] = fp
+            if md5:
+                self.fpByMd5[md5] = fp
 
-        self.__cacheDirty = True
+        self.__setChanged(file)
 
     def deleteFingerprint(self, fp):
         assert fp.file in self.fpByFile
@@ -140,7 +409,7 @@ class FPCache:
         if fp.md5 in self.fpByMd5:
             del self.fpByMd5[fp.md5]
 
-        self.__cacheDirty = True
+        self.__setChanged(fp.file)
 
     def haveDeletedFiles(self, lsFiles):
         # for each file in the cache, check if it can be 'ls'ed
@@ -163,7 +432,7 @@ class FPCache:
                     del self.fpByMd5[self.fpByFile[f].md5]
                 del self.fpByFile[f]
 
-                self.__cacheDirty = True
+                self.__setChanged(f)
 
     def checkFile(self, fp):
         # check if a file with the fingerprint exists and also confirm 
@@ -184,12 +453,91 @@ class FPCache:
         else:
             return None
 
-class FileStat:
+## This function returns the modify time of a stat result in nanoseconds.
+#  os.stat only has the modify time as a float in Python 2, which is exact to
+#  the microsecond for current dates, so it is rounded to the microsecond.
+#  The nanoseconds some DirEntry.stat results have are not used then, so that
+#  every stat of a file gives the same modify time.
+def mtimeNs(st):
+    if sys.version_info >= (3, 3):
+        return st.st_mtime_ns
+    return long(round(st.st_mtime * 1000000)) * 1000
+
+## This function checks if a recorded modify time matches a modify time in
+#  nanoseconds. Records written before nanosecond modify times hold float
+#  seconds that were rounded when they were written, so they are compared to
+#  the second.
+def sameMtime(recorded, ns):
+    if isinstance(recorded, float):
+        return long(recorded) == ns // 1000000000
+    return recorded == ns
+
+# directories whose BloomFilter was removed in this run, see dropRefFilters
+_droppedFilterDirs = set()
+
+## This function removes the BloomFilters of a directory and of all its
+#  ancestors. It is called whenever fingerprints of the directory are
+#  written, by any mode, as the filter of every tree the directory is in no
+#  longer holds all the tree's digests. So a filter only exists while it is
+#  up to date, see Directory.checkFile.
+#  - A directory's filter is removed once per run, so a flush only walks up
+#    to the first ancestor already handled, until a filter is written again,
+#    see keepRefFilters.
+#  - Another process, e.g. a shard worker, may remove the same filter.
+def dropRefFilters(path):
+    while path not in _droppedFilterDirs:
+        _droppedFilterDirs.add(path)
+        try:
+            os.remove(os.path.join(Directory.workDirOf(path), ".dp", BloomFilter.FILE_NAME))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+## This function records that a filter was written for the tree at path, so
+#  that writing fingerprints below it removes the filter again
+def keepRefFilters(path):
+    prefix = os.path.join(path, "")
+    _droppedFilterDirs.difference_update([d for d in _droppedFilterDirs\
+                                          if d == path or d.startswith(prefix)])
+
+## This function parses a modify time field of a fingerprint database
+def parseMtime(field):
+    if "." in field or "e" in field:
+        return float(field)
+    return long(field)
+
+## The metadata of a file that change detection and fingerprints need, taken
+#  from a single stat
+class FileMeta(collections.namedtuple("FileMeta", ["size", "mtimeNs", "ino", "dev"])):
+    __slots__ = ()
+
+    @staticmethod
+    def fromStat(st):
+        return FileMeta(st.st_size, mtimeNs(st), st.st_ino, st.st_dev)
+
+class FileStat(object):
+    __slots__ = ("fileName", "dirEntry", "__meta")
+
     def __init__(self, dirEntry):
         assert dirEntry.is_file()
 
         self.fileName = dirEntry.name
         self.dirEntry = dirEntry
+        self.__meta = None
+
+    ## This function returns the FileMeta of the file. The file is stat'ed on
+    #  the first call only; the directory listing does not stat files, so
+    #  directories skipped as unchanged cost no stat per file.
+    def stat(self):
+        if self.__meta == None:
+            with Stats.Timer("stat"):
+                self.__meta = FileMeta.fromStat(self.dirEntry.stat())
+            Stats.count("stats")
+        return self.__meta
 
 class Directory:
     def __repr__(self):
@@ -208,12 +556,43 @@ class Directory:
                    "/media/divya/win_vol/Users/manaswini/Videos",\
                    )
 
-    class __DupInfo:
+    class __DupInfo(object):
+        __slots__ = ("file", "fp", "origFp")
+
         def __init__(self, file, fp, origFp):
             self.file = file
             self.fp = fp
             self.origFp = origFp
 
+    ## A file of a reference tree in the size index of the tree, see
+    #  __buildSizeIndex. Digests that are not in the tree's fingerprints are
+    #  computed when first needed and only kept in memory.
+    class __RefFile(object):
+        __slots__ = ("dir", "file", "size", "mtime", "md5", "partial")
+
+        def __init__(self, dir, file, size, mtime, md5, partial):
+            self.dir = dir
+            self.file = file
+            self.size = size
+            self.mtime = mtime
+            self.md5 = md5
+            self.partial = partial
+
+        def getPartial(self):
+            if not self.partial:
+                self.partial = Hasher.partialHashFile(os.path.join(self.dir, self.file), self.size)
+                if self.size <= 2 * Hasher.PARTIAL_HASH_BYTES:
+                    self.md5 = self.partial
+            return self.partial
+
+        def getMd5(self):
+            if not self.md5:
+                self.md5 = Hasher.hashFile(os.path.join(self.dir, self.file))
+            return self.md5
+
+        def toFingerprint(self):
+            return Fingerprint(self.file, self.dir, self.md5, self.mtime, self.size, self.partial)
+
     @staticmethod
     def __getScriptDir():
         scriptDir = os.path.dirname(os.path.realpath(__file__))
@@ -221,28 +600,50 @@ class Directory:
             raise Exception("unable to figure out script directory")
         return scriptDir
 
-    __rdOnlyDirs = []
-    __rdOnlyDirsCheckDone = False
-    @staticmethod
-    def __getRdOnlyDirsList():
-        if Directory.__rdOnlyDirsCheckDone:
-            return __rdOnlyDirs
+    ## Trie of the read only directories listed in rd_only_dirs, one level per
+    #  path component. The node of a listed directory maps "" to its path.
+    __rdOnlyTrie = None
 
-        Directory.rdOlyDirs = True
+    ## This function parses rd_only_dirs into a trie, once. Empty lines and
+    #  lines starting with '#' are skipped.
+    @staticmethod
+    def __getRdOnlyTrie():
+        if Directory.__rdOnlyTrie != None:
+            return Directory.__rdOnlyTrie
 
+        trie = dict()
         f = os.path.join(Directory.__getScriptDir(), "rd_only_dirs")
-        if not os.path.isfile(f):
-            # no read only dirs have been defined
-            return Directory.__rdOnlyDirs
-
-        fh = open(f, "r")
-        for l in fh:
-            l = l.rstrip()
-            if not l:
+        if os.path.isfile(f):
+            with open(f, "r") as fh:
+                for l in fh:
+                    l = l.strip()
+                    if not l or l.startswith("#"):
+                        continue
+
+                    rdDir = os.path.abspath(l)
+                    node = trie
+                    for part in rdDir.split(os.sep):
+                        if part:
+                            node = node.setdefault(part, dict())
+                    node[""] = rdDir
+
+        Directory.__rdOnlyTrie = trie
+        return trie
+
+    ## This function returns the deepest read only directory a path is in
+    #  @return the read only directory or None
+    @staticmethod
+    def __findRdOnlyParent(path):
+        node = Directory.__getRdOnlyTrie()
+        rdParent = node.get("")
+        for part in path.split(os.sep):
+            if not part:
                 continue
-            Directory.__rdOnlyDirs.append(l)
-
-        return Directory.__rdOnlyDirs
+            node = node.get(part)
+            if node == None:
+                break
+            rdParent = node.get("", rdParent)
+        return rdParent
 
     # This function returns path to dpWorkDir if the directory provided is in a
     # read only directory
@@ -250,27 +651,32 @@ class Directory:
     def __getAltWorkDir(dir):
         path = os.path.abspath(dir)
 
-        # check if the directory is in read only directory and get the path to the
-        # parent
-        rdDirs = Directory.__getRdOnlyDirsList()
-        rdParent = None
-        for d in rdDirs:
-            if d in path:
-                rdParent = d
-                break
-
         # return None if the directory is not in a read-only parent
+        rdParent = Directory.__findRdOnlyParent(path)
         if rdParent == None:
            return None
 
         # replace rdParent with path to the dpWorkDir
         dpWorkDir = os.path.join(Directory.__getScriptDir(), 'dp_work_dir')
-        path = path.replace(rdParent, dpWorkDir)
-        return path
- 
+        return os.path.normpath(os.path.join(dpWorkDir, os.path.relpath(path, rdParent)))
 
-
-    def __init__(self, path, checkMode=False):
+    ## This function returns the directory the fingerprints and logs of a
+    #  directory are kept in: the directory itself, or its mirror in
+    #  dp_work_dir if it is in a read only directory
+    @staticmethod
+    def workDirOf(path):
+        workDir = Directory.__getAltWorkDir(path)
+        return workDir if workDir != None else os.path.abspath(path)
+
+    ## Constructor
+    #  @param path - path to the directory
+    #  @param checkMode - the directory is only used as a reference
+    #  @param useIndex - keep the fingerprints of the whole tree in a single
+    #                    FPIndex in the .dp directory of this directory. By
+    #                    default the index is used if it exists.
+    #  @param index - FPIndex of the tree this directory is part of. Only used
+    #                 when creating sub directories.
+    def __init__(self, path, checkMode=False, useIndex=None, index=None):
         if not os.path.isdir(path):
             raise Exception(path + " does not exist or is not a directory")
 
@@ -286,20 +692,54 @@ class Directory:
 
         self.privDir = os.path.join(self.dpWorkDir, ".dp")
         self.logDir = os.path.join(self.privDir, "logs")
-        Directory.__createDirectory(self.logDir)
+        if Logger.Logger.runLogFile == None and not Logger.Logger.toStdOut:
+            Directory.__createDirectory(self.logDir)
         self.logFile = os.path.join(self.logDir, Logger.Logger.newLogFileName())
         self.logger = Logger.Logger(self.logFile, self.dirName)
 
-        self.fpDBFile = os.path.join(self.privDir, "fpDB.txt")
-        self.fpCache = FPCache(self.fpDBFile, self.logger)
+        if index == None:
+            indexFile = os.path.join(self.privDir, FPIndex.FILE_NAME)
+            if useIndex or (useIndex == None and os.path.isfile(indexFile)):
+                self.logger.info("using fingerprint index {}...".format(indexFile))
+                Directory.__createDirectory(self.privDir)
+                index = FPIndex(indexFile, self.dpWorkDir)
+        self.index = index
 
+        self.fpDBFile = os.path.join(self.privDir, "fpDB.txt")
+        self.fpCache = FPCache(self.fpDBFile, self.logger, self.index, self.path)
+
+        # stat the directory before listing it, so a change made while it is
+        # being processed shows up in the next run. If the fingerprint
+        # database of the directory is written, .dp is created first, as
+        # creating it changes the modify time of the directory. Otherwise the
+        # directory is left as it is, e.g. in a read only tree.
+        if self.index == None and not checkMode:
+            Directory.__createDirectory(self.privDir)
+        with Stats.Timer("stat"):
+            self.dirMtime = mtimeNs(os.stat(self.path))
+        Stats.count("stats")
         self.fstatByName = dict()
-        self.subDirs = []
+        self.subDirPaths = []
         self.__lsDir()
 
-    ## This function creates Directory object for each subdirectory and caches the modify times for
-    #  all files
+        # map of digest -> fingerprints for the whole tree, see checkFile
+        self.__digestIndex = None
+        # algorithms of the digests in the digest index, see __warnMixedAlgorithms
+        self.__algorithms = None
+        # BloomFilter of the tree, False if there is none, see checkFile
+        self.__refFilter = None
+
+    ## This function lists the subdirectories and caches the modify times for all files.
+    #  Directory objects for the subdirectories are only created when they are
+    #  walked, see __iterSubDirs.
     def __lsDir(self):
+        with Stats.Timer("scan"):
+            self.__scanDir()
+        Stats.count("dirsScanned")
+        Stats.count("filesScanned", len(self.fstatByName))
+        Stats.progress()
+
+    def __scanDir(self):
         for element in scandir(self.path):
             if element.name == ".dp":
                 continue
@@ -308,7 +748,7 @@ class Directory:
                     self.logger.warn("ignoring {}...".format(element.path))
                     continue
 
-                self.subDirs.append(Directory(element.path))
+                self.subDirPaths.append(element.path)
             elif element.is_file() and element.name not in Directory.IgnoredFiles:
                 self.fstatByName[element.name] = FileStat(element)
 
@@ -321,177 +761,1079 @@ class Directory:
 
     def __hasFileChanged(self, file):
         fp = self.fpCache.getFpForFile(file.fileName)
-
-        return None == fp\
-                or fp.size != file.dirEntry.stat().st_size\
-                or long(fp.mtime) < long(file.dirEntry.stat().st_mtime)
-
+        if None == fp:
+            return True
+
+        meta = file.stat()
+        return fp.size != meta.size or not sameMtime(fp.mtime, meta.mtimeNs)
+
+    ## A file needs a digest if it has changed or if it was recorded without a
+    #  full digest by a previous --size-prefilter run
+    #  @param upgrade - a digest made with another algorithm than the one
+    #                   configured in Hasher is replaced too
+    def __needsDigest(self, file, upgrade=False):
+        if self.__hasFileChanged(file):
+            return True
+
+        md5 = self.fpCache.getFpForFile(file.fileName).md5
+        return not md5 or (upgrade and not Directory.__isCurrent(md5, file.stat().size))
+
+    ## This function checks if a stored digest was made the way a new digest
+    #  would be made: with the configured algorithm and, for a full digest of
+    #  a large file, in chunks
+    #  @param size - size of the file for a full digest, None for a partial one
     @staticmethod
-    def __hashFile(file):
-        BUF_SIZE = 65536
-
-        md5 = hashlib.md5()
+    def __isCurrent(digest, size=None):
+        return digest != "" and Hasher.algorithmOf(digest)\
+                == (Hasher.algorithm if size == None else Hasher.algorithmFor(size))
+
+    ## This function creates the Directory object of each sub directory as it
+    #  is needed. A sub directory, with its fingerprint cache and logger, is
+    #  released as soon as the caller drops it, so only the directories on the
+    #  path being walked are in memory.
+    #  @param skip - function(path) returning True for sub directories to leave out
+    def __iterSubDirs(self, skip=None):
+        for path in self.subDirPaths:
+            if skip == None or not skip(path):
+                yield Directory(path, self.checkMode, False, self.index)
+
+    ## This function yields the directories in the tree, sub directories before
+    #  their parent unless topDown is set
+    #  @param skip - function(path) returning True for sub directories whose
+    #                subtree is left out
+    def __walk(self, topDown=False, skip=None):
+        if topDown:
+            yield self
+
+        for subdir in self.__iterSubDirs(skip):
+            for d in subdir.__walk(topDown, skip):
+                yield d
+
+        if not topDown:
+            yield self
+
+    ## This function yields the directories in the tree top down. The
+    #  subtree of a directory for which prune(dir) returns True is left out,
+    #  the directory included.
+    def walkPruned(self, prune):
+        if prune(self):
+            return
+        yield self
+
+        for subdir in self.__iterSubDirs():
+            for d in subdir.walkPruned(prune):
+                yield d
+
+    ## This function returns the file the progress of the chunked hash of a
+    #  large file is saved to, see Hasher.hashFile
+    def __progressFile(self, f):
+        return os.path.join(self.privDir, "progress", f + ".chunks")
+
+    def __recordDigest(self, info, md5, partial=""):
+        meta = info.stat()
+        self.fpCache.addFingerprint(info.fileName, md5, meta.mtimeNs, meta.size, partial)
+        self.fpCache.checkpoint()
+
+    ## This function checks if the directory's entries are the same as when it
+    #  was last fingerprinted, using the stat taken when it was listed.
+    #  Note that a file rewritten in place does not change the directory.
+    def __isUnchanged(self):
+        stamp = self.fpCache.stamp
+        return stamp != None\
+                and stamp.mtime == self.dirMtime\
+                and stamp.count == len(self.fstatByName) + len(self.subDirPaths)\
+                and self.fpCache.isComplete()
+
+    ## This function computes the stamp of the directory
+    #  @param rollups - dict of directory path -> rollup of the directories that
+    #                   have been finished. The rollups of the sub directories
+    #                   are removed from it.
+    def __makeStamp(self, rollups):
+        count = len(self.fstatByName) + len(self.subDirPaths)
+        md5 = hashlib.md5("{}|{}".format(self.dirMtime, count))
+        for name, rollup in sorted((os.path.basename(p), rollups.pop(p, ""))\
+                                   for p in self.subDirPaths):
+            md5.update("|{}:{}".format(name, rollup))
+
+        return DirStamp(self.dirMtime, count, md5.hexdigest())
+
+    ## This function computes the Merkle digest of the directory from the
+    #  digests of its files and the Merkle digests of its sub directories.
+    #  Names are not part of the digest, so a copy of a directory under another
+    #  name has the same digest.
+    #  @param merkles - dict of directory path -> Merkle digest of the
+    #                   directories that have been finished. The digests of the
+    #                   sub directories are removed from it.
+    #  @return the digest or an empty string if a file in the subtree has no
+    #          full digest
+    def __makeMerkle(self, merkles):
+        digests = []
+        complete = True
+        for p in self.subDirPaths:
+            merkle = merkles.pop(p, "")
+            complete = complete and merkle != ""
+            digests.append("d:" + merkle)
 
-        with open(file, 'rb') as f:
-            while True:
-                data = f.read(BUF_SIZE)
-                if not data:
-                    break
+        for f in self.fstatByName.keys():
+            fp = self.fpCache.getFpForFile(f)
+            if fp == None or not fp.md5:
+                complete = False
+                break
+            digests.append("f:" + fp.md5)
 
-                md5.update(data)
+        if not complete:
+            return ""
 
+        md5 = hashlib.md5()
+        for digest in sorted(digests):
+            md5.update(digest)
         return md5.hexdigest()
 
-    def __fingerprintFile(self, file):
-        self.fpCache.addFingerprint(file.dirEntry.name,
-                                    Directory.__hashFile(file.dirEntry.path),\
-                                    file.dirEntry.stat().st_mtime,\
-                                    file.dirEntry.stat().st_size)
-
-    def fingerPrint(self, dryRun=False):
-        if self.checkMode:
-            raise Exception("fingerprinting is not allowed in check mode")
-
-        self.logger.info("fingerprinting {}...".format(os.path.basename(self.path)))
-
-        # finger print sub directories first
-        for subdir in self.subDirs:
-            self.logger.info("fingerprinting {}...".format(os.path.basename(subdir.path)))
-            subdir.fingerPrint(dryRun)
-
-        # fingerprint files
-        for f, info in self.fstatByName.iteritems():
-            if self.__hasFileChanged(info):
-                self.logger.info("fingerprinting {}...".format(f))
-                if not dryRun:
-                    self.__fingerprintFile(info)
-
+    def __finishFingerprint(self, dryRun, rollups, merkles):
         # handle file deletes
         if self.fpCache.haveDeletedFiles(self.fstatByName.keys()):
             self.logger.info("removing fingerprint for deletes files...")
             if not dryRun :
                 self.fpCache.removeFPForDeletedFiles(self.fstatByName.keys())
 
+        if not dryRun:
+            stamp = self.__makeStamp(rollups)
+            self.fpCache.setStamp(stamp)
+            rollups[self.path] = stamp.rollup
+
+            merkles[self.path] = self.__makeMerkle(merkles)
+            self.fpCache.setMerkle(merkles[self.path])
+
         # flush to DB
         if dryRun:
             assert not self.fpCache.isDirty()
         else:
             self.fpCache.flushCache()
 
+    ## This function hashes the files of every directory in the tree on the
+    #  pool. Directories are finished, i.e. their digests are recorded and their
+    #  cache is flushed, in walk order once all their files are hashed. A
+    #  bounded number of directories is kept in flight so that the workers stay
+    #  busy across small directories.
+    #  @param plan - function(dir) returning a list of (func, args, done, meta).
+    #                func is called on the pool with args and done is called
+    #                with its result when the directory is finished. meta is
+    #                the FileMeta of the file args[0], see IOScheduler.
+    #  @param recursive - if not set, only this directory is hashed. The
+    #                    rollups and Merkle digests of its sub directories are
+    #                    then read from their caches.
+    #  @param onFinish - function(dir) called once a directory is finished
+    #  @return list of the work directories in the tree
+    def __hashTree(self, pool, dryRun, plan, recursive=True, onFinish=None):
+        workDirs = []
+        pending = collections.deque()
+        queued = 0
+        rollups = dict()
+        merkles = dict()
+        if not recursive:
+            for subdir in self.__iterSubDirs():
+                stamp = subdir.fpCache.stamp
+                rollups[subdir.path] = stamp.rollup if stamp != None else ""
+                merkles[subdir.path] = subdir.fpCache.merkle
+                subdir = None
+
+        def finish():
+            d, work = pending.popleft()
+            for result, done in work:
+                done(result.get())
+            d.__finishFingerprint(dryRun, rollups, merkles)
+            if onFinish != None:
+                onFinish(d)
+            Stats.progress()
+            return len(work)
+
+        for d in (self.__walk() if recursive else [self]):
+            d.logger.info("fingerprinting {}...".format(d.dirName))
+            workDirs.append(d.dpWorkDir)
+
+            work = [(pool.submit(func, args, meta), done) for func, args, done, meta in plan(d)]
+            pending.append((d, work))
+            queued += len(work)
+            d = None
+
+            while pending and (queued > pool.window or len(pending) > pool.window):
+                queued -= finish()
+
+        while pending:
+            finish()
+
+        return workDirs
+
+    ## This function fingerprints the files in the tree using a staged pipeline:
+    #  1. files are bucketed by size. A file with a unique size can not have a
+    #     duplicate and is recorded without any digest.
+    #  2. files in a size collision get a partial digest of their head and tail.
+    #  3. only files whose partial digest collides too are hashed in full.
+    #  Digests already in the cache are reused for files that have not changed.
+    #  Each stage walks the tree, so a directory's cache is flushed once per
+    #  stage that changes it. Files that appear or change size while the tree
+    #  is walked count as files with a unique size.
+    #  @return list of the work directories in the tree
+    def __fingerPrintBySize(self, dryRun, pool, onFinish=None):
+        smallFile = 2 * Hasher.PARTIAL_HASH_BYTES
+
+        # number of files of each size, from the FileMeta of the files
+        sizes = dict()
+        for d in self.__walk():
+            for info in d.fstatByName.itervalues():
+                size = info.stat().size
+                sizes[size] = sizes.get(size, 0) + 1
+
+        # partial digests
+        partials = dict()
+        def countPartial(size, partial):
+            partials[(size, partial)] = partials.get((size, partial), 0) + 1
+
+        def recordPartial(d, info, size, partial):
+            fp = d.fpCache.getFpForFile(info.fileName)
+            if size <= smallFile:
+                md5 = partial
+            elif fp != None and not d.__hasFileChanged(info) and Directory.__isCurrent(fp.md5, size):
+                md5 = fp.md5
+            else:
+                md5 = ""
+            d.__recordDigest(info, md5, partial)
+            countPartial(size, partial)
+
+        def planPartials(d):
+            work = []
+            for f, info in d.fstatByName.iteritems():
+                size = info.stat().size
+                fp = d.fpCache.getFpForFile(f)
+                if sizes.get(size, 0) <= 1:
+                    if d.__hasFileChanged(info):
+                        d.logger.info("{} has a unique size, skipping digest...", f)
+                        if not dryRun:
+                            d.__recordDigest(info, "")
+                    else:
+                        Stats.count("filesUnchanged")
+                elif d.__hasFileChanged(info) or not Directory.__isCurrent(fp.partial):
+                    d.logger.info("computing partial digest of {}...", f)
+                    if not dryRun:
+                        work.append((Hasher.partialHashFile, (info.dirEntry.path, size),\
+                                     lambda partial, d=d, info=info, size=size:\
+                                         recordPartial(d, info, size, partial), info.stat()))
+                else:
+                    Stats.count("filesUnchanged")
+                    countPartial(size, fp.partial)
+            return work
+
+        workDirs = self.__hashTree(pool, dryRun, planPartials)
+        if dryRun:
+            return workDirs
+
+        # full digests
+        def planDigests(d):
+            work = []
+            for f, info in d.fstatByName.iteritems():
+                size = info.stat().size
+                if sizes.get(size, 0) <= 1 or size <= smallFile:
+                    continue
+
+                fp = d.fpCache.getFpForFile(f)
+                if fp == None:
+                    continue
+                if partials.get((size, fp.partial), 0) > 1 and not Directory.__isCurrent(fp.md5, size):
+                    d.logger.info("fingerprinting {}...", f)
+                    work.append((Hasher.hashFile, (info.dirEntry.path, d.__progressFile(f)),\
+                                 lambda md5, d=d, info=info, partial=fp.partial:\
+                                     d.__recordDigest(info, md5, partial), info.stat()))
+            return work
+
+        self.__hashTree(pool, dryRun, planDigests, onFinish=onFinish)
+        return workDirs
+
+    ## This function lists the files of the directory that need a digest
+    #  @return list of (func, args, done, meta), see __hashTree
+    def __planDigests(self, dryRun, skipUnchanged, upgradeDigests):
+        if skipUnchanged and self.__isUnchanged()\
+                and (not upgradeDigests or self.fpCache.isComplete(True)):
+            self.logger.info("{} has not changed, skipping files...", self.dirName)
+            Stats.count("dirsUnchanged")
+            Stats.count("filesUnchanged", len(self.fstatByName))
+            return []
+
+        work = []
+        for f, info in self.fstatByName.iteritems():
+            if self.__needsDigest(info, upgradeDigests):
+                self.logger.info("fingerprinting {}...", f)
+                if not dryRun:
+                    work.append((Hasher.hashFile, (info.dirEntry.path, self.__progressFile(f)),\
+                                 lambda md5, info=info: self.__recordDigest(info, md5), info.stat()))
+            else:
+                Stats.count("filesUnchanged")
+        return work
+
+    ## This function fingerprints the files of the directory again, e.g.
+    #  after they were reported changed. Only files whose size or modify time
+    #  changed are hashed. The stamp and Merkle digest of the directory are
+    #  computed again, from those recorded for its sub directories unless
+    #  recursive is set.
+    #  @param pool - HashPool to hash the files on
+    #  @param recursive - fingerprint the whole subtree
+    def refresh(self, pool, recursive=False):
+        if self.checkMode:
+            raise Exception("fingerprinting is not allowed in check mode")
+
+        self.__hashTree(pool, False, lambda d: d.__planDigests(False, False, False), recursive)
+
+    ## This function fingerprints all the files in the directory tree.
+    #  @param dryRun - only log the files that would be fingerprinted
+    #  @param sizePrefilter - only hash files whose size collides with another
+    #                         file in the tree, see __fingerPrintBySize
+    #  @param jobs - number of files to hash concurrently. Digests are applied
+    #                to each directory's cache in walk order and each cache is
+    #                flushed once, after all its files are hashed.
+    #  @param skipUnchanged - do not check the files of directories whose entries
+    #                         have not changed since they were last fingerprinted,
+    #                         see __isUnchanged. Files rewritten in place are missed.
+    #  @param upgradeDigests - re-hash files whose digest was made with another
+    #                          algorithm than the one configured in Hasher
+    #  @param ioOrder - read files in their order on disk, with at most jobs
+    #                   files read at a time from each device, see IOScheduler
+    #  @param writeFilter - write the BloomFilter of the tree, see checkFile
+    def fingerPrint(self, dryRun=False, sizePrefilter=False, jobs=1, skipUnchanged=False,\
+                    upgradeDigests=False, ioOrder=False, writeFilter=True):
+        if self.checkMode:
+            raise Exception("fingerprinting is not allowed in check mode")
+        if sizePrefilter and skipUnchanged:
+            raise Exception("unchanged directories can not be skipped with the size prefilter")
+
+        self.logger.info("fingerprinting {}...".format(os.path.basename(self.path)))
+
+        def planDigests(d):
+            return d.__planDigests(dryRun, skipUnchanged, upgradeDigests)
+
+        # keys of the BloomFilter, collected as directories are finished
+        keys = None
+        addKeys = None
+        algorithms = dict()
+        if writeFilter and not dryRun:
+            keys = BloomFilter.newKeys()
+            def addKeys(d):
+                for fp in d.fpCache.fpByFile.itervalues():
+                    if fp.md5:
+                        BloomFilter.add(keys, fp.md5, fp.size)
+                        algorithms.setdefault(Hasher.algorithmFor(fp.size), set())\
+                                  .add(Hasher.algorithmOf(fp.md5))
+
+        if not dryRun:
+            dropRefFilters(self.path)
+
+        pool = IOScheduler(jobs) if ioOrder else Hasher.HashPool(jobs)
+        try:
+            if sizePrefilter:
+                workDirs = self.__fingerPrintBySize(dryRun, pool, addKeys)
+            else:
+                workDirs = self.__hashTree(pool, dryRun, planDigests, onFinish=addKeys)
+        finally:
+            pool.close()
+
+        if keys != None:
+            Directory.__createDirectory(self.privDir)
+            with Stats.Timer("filter"):
+                bits = BloomFilter.write(os.path.join(self.privDir, BloomFilter.FILE_NAME),
+                                         keys, self.fpCache.stamp.rollup, algorithms)
+            keepRefFilters(self.path)
+            self.logger.info("wrote filter of {} files in {} bytes", len(keys) // 2, bits // 8)
+
+        if self.index != None and not dryRun:
+            pruned = self.index.pruneDirs(workDirs)
+            if pruned:
+                self.logger.info("removed fingerprints of {} deleted directories from index".format(pruned))
+
         self.logger.info("fingerprinting done")
 
     def checkFile(self, fp):
-        self.logger.debug("checking for file <{},{},{}>...".format(fp.file, fp.md5, fp.size))
-
-        # check current directory first
-        orig = self.fpCache.checkFile(fp)
+        Stats.count("lookups")
+        Stats.progress()
+        with Stats.Timer("lookup"):
+            orig = self.__lookup(fp)
         if orig != None:
-            return orig
+            Stats.count("lookupHits")
+        return orig
+
+    def __lookup(self, fp):
+        self.logger.debug("checking for file <{},{},{}>...", fp.file, fp.md5, fp.size)
+
+        # most files of a tree that is mostly new are not in the reference, so
+        # they are ruled out by the filter without reading its fingerprints
+        if self.__refFilter == None:
+            self.__refFilter = self.__loadRefFilter()
+        if self.__refFilter:
+            self.__checkAlgorithm(fp, self.__refFilter.algorithms)
+            if not self.__refFilter.mightContain(fp.md5, fp.size):
+                Stats.count("filterNegatives")
+                return None
 
-        # check sub directories
-        for dir in self.subDirs:
-            orig = dir.checkFile(fp)
-            if None != orig:
-                return orig
+        # a single lookup is enough if the fingerprints of the whole tree are in
+        # an index
+        if self.index != None:
+            return self.__checkFileInIndex(fp)
+
+        # the digests of the whole tree are collected on the first lookup, so
+        # every lookup is a single dict access instead of a walk over all the
+        # sub directories
+        if self.__digestIndex == None:
+            self.__digestIndex = self.__buildDigestIndex()
+            self.__algorithms = self.__warnMixedAlgorithms(self.__digestIndex)
+        self.__checkAlgorithm(fp, self.__algorithms)
+
+        fps = self.__digestIndex.get(Hasher.packDigest(fp.md5))
+        if fps == None:
+            return None
+
+        return self.__confirmDup(fp, fps[0] if isinstance(fps, list) else fps)
+
+    ## This function logs a warning if a file is looked up with a digest of an
+    #  algorithm the tree has no digests of for files of its size, as it can
+    #  not match any of them. The warning is logged once per algorithm.
+    #  @param algorithmsByScheme - see __warnMixedAlgorithms
+    def __checkAlgorithm(self, fp, algorithmsByScheme):
+        algorithms = algorithmsByScheme.get(Hasher.algorithmFor(fp.size))
+        algorithm = Hasher.algorithmOf(fp.md5)
+        if algorithms and algorithm not in algorithms:
+            self.logger.warn("{} has a digest of algorithm {}, but {} only has {} digests for files of "\
+                             "its size. fingerprint both with --upgrade-digests to use one algorithm",
+                             fp.path, algorithm, self.path, ", ".join(sorted(algorithms)))
+            algorithms.add(algorithm)
+
+    ## This function opens the BloomFilter of the tree, if it has one. Writing
+    #  fingerprints below the tree removes its filter, see dropRefFilters; the
+    #  rollup is checked as well in case the filter was copied along with the
+    #  .dp directory.
+    #  @return the filter or False
+    def __loadRefFilter(self):
+        path = os.path.join(self.privDir, BloomFilter.FILE_NAME)
+        if not os.path.isfile(path):
+            return False
+
+        try:
+            filter = BloomFilter(path)
+        except Exception as e:
+            self.logger.warn("ignoring filter: {}", e)
+            return False
+        if self.fpCache.stamp == None or filter.rollup != self.fpCache.stamp.rollup:
+            self.logger.info("{} changed since its filter was written, not using it", self.path)
+            filter.close()
+            return False
+
+        self.logger.info("using filter of {} files", filter.count)
+        return filter
+
+    ## This function adds a fingerprint to a map of digest -> fingerprints
+    #  - Digests are packed, see Hasher.packDigest.
+    #  - A digest maps to its only fingerprint, or to a list of fingerprints if
+    #    there are several, as most digests of a tree have a single file.
+    @staticmethod
+    def __addToDigestMap(digests, fp):
+        key = Hasher.packDigest(fp.md5)
+        fps = digests.get(key)
+        if fps == None:
+            digests[key] = fp
+        elif isinstance(fps, list):
+            fps.append(fp)
+        else:
+            digests[key] = [fps, fp]
+
+    ## This function collects the fingerprints of the tree by digest, see
+    #  __addToDigestMap. The fingerprints for a digest are in the order the
+    #  tree used to be searched in, i.e. a directory before its sub directories.
+    def __buildDigestIndex(self):
+        self.logger.info("building digest index of {}...".format(self.path))
+        digests = dict()
+        for d in self.__walk(True):
+            for fp in d.fpCache.fpByMd5.itervalues():
+                Directory.__addToDigestMap(digests, fp)
+
+        self.logger.info("digest index has {} digests".format(len(digests)))
+        return digests
+
+    ## This function makes sure that the file found for a digest is the same
+    #  size as the file looked up
+    def __confirmDup(self, fp, orig):
+        self.logger.info("found a dup. remote: <{},{},{}>, local: <{},{},{}>",\
+                         fp.path, fp.md5, fp.size, orig.path, orig.md5, orig.size)
+        if fp.size != orig.size:
+            msg = "sizes don't match! remote file size: {}, local file size: {}"\
+                    .format(fp.size, orig.size)
+            self.logger.warn(msg)
+            raise Exception(msg)
+
+        return orig
+
+    def __checkFileInIndex(self, fp):
+        root = os.path.join(self.dpWorkDir, "")
+        for dir, file, md5, mtime, size, partial in self.index.lookupMd5(fp.md5):
+            if dir != self.dpWorkDir and not dir.startswith(root):
+                continue
+
+            # report the path of the file, not of its work directory
+            orig = Fingerprint(file, self.path + dir[len(self.dpWorkDir):], md5, mtime, size, partial)
+            return self.__confirmDup(fp, orig)
 
         return None
 
-    def removeDups(self, refDir, compareOnly=False):
+    ## This function copies the fingerprint database files of the tree into a
+    #  new FPIndex in the .dp directory of this directory
+    def importToIndex(self):
+        if self.index != None:
+            raise Exception("{} already uses a fingerprint index".format(self.path))
+
+        indexFile = os.path.join(self.privDir, FPIndex.FILE_NAME)
+        self.logger.info("importing fingerprint databases into {}...".format(indexFile))
+        index = FPIndex(indexFile, self.dpWorkDir)
+        for d in self.__walk():
+            index.writeDir(d.dpWorkDir, d.fpCache.fpByFile.values())
+        index.close()
+        self.logger.info("import done")
+
+    ## This function writes the fingerprints in the index to a fingerprint
+    #  database file in each directory
+    def exportFromIndex(self):
+        if self.index == None:
+            raise Exception("{} does not use a fingerprint index".format(self.path))
+
+        self.logger.info("exporting fingerprint index...")
+        for d in self.__walk():
+            d.fpCache.exportDB()
+        self.logger.info("export done")
+
+    ## This function returns the fingerprint of a file, making sure that the
+    #  file was hashed in full
+    def __getFullFp(self, file):
+        fp = self.fpCache.getFpForFile(file)
+        if None == fp:
+            raise Exception("directory {} needs to be fingerprinted".format(self.path))
+        if not fp.md5:
+            raise Exception("{} has no full digest. fingerprint {} without --size-prefilter"\
+                            .format(fp.path, self.path))
+        return fp
+
+    ## This function collects the files of the tree by size, with the digests
+    #  of the files whose fingerprints are up to date
+    #  @return dict of size -> list of __RefFile
+    def __buildSizeIndex(self):
+        self.logger.info("building size index of {}...".format(self.path))
+        sizes = dict()
+        for d in self.__walk(True):
+            for f, info in d.fstatByName.iteritems():
+                meta = info.stat()
+                md5 = partial = ""
+                fp = d.fpCache.getFpForFile(f)
+                if fp != None and not d.__hasFileChanged(info):
+                    md5 = fp.md5 if Directory.__isCurrent(fp.md5, meta.size) else ""
+                    partial = fp.partial if Directory.__isCurrent(fp.partial) else ""
+                sizes.setdefault(meta.size, []).append(\
+                    Directory.__RefFile(d.path, f, meta.size, meta.mtimeNs, md5, partial))
+
+        self.logger.info("size index has {} sizes".format(len(sizes)))
+        return sizes
+
+    ## This function looks for a file in the size index of a reference tree.
+    #  Only the files of the same size are compared, first by partial digest
+    #  and then by full digest, and digests are computed as they are needed.
+    #  The digests computed for the file are recorded in the cache unless
+    #  compareOnly is set.
+    #  @return fingerprint of the file and fingerprint of its dup in the
+    #          reference tree or None
+    def __findDupBySize(self, f, sizeIndex, compareOnly):
+        Stats.count("lookups")
+        info = self.fstatByName[f]
+        meta = info.stat()
+        refs = sizeIndex.get(meta.size)
+        if not refs:
+            Stats.count("filesUniqueBySize")
+            return None, None
+
+        fp = self.fpCache.getFpForFile(f)
+        md5 = partial = ""
+        if fp != None and not self.__hasFileChanged(info):
+            md5 = fp.md5 if Directory.__isCurrent(fp.md5, meta.size) else ""
+            partial = fp.partial if Directory.__isCurrent(fp.partial) else ""
+
+        orig = None
+        for ref in refs:
+            # partial digests are only needed if a full digest is missing
+            if not md5 or not ref.md5:
+                if not partial:
+                    partial = Hasher.partialHashFile(info.dirEntry.path, meta.size)
+                    if meta.size <= 2 * Hasher.PARTIAL_HASH_BYTES:
+                        md5 = partial
+                if ref.getPartial() != partial:
+                    continue
+
+            if not md5:
+                md5 = Hasher.hashFile(info.dirEntry.path,
+                                      None if compareOnly else self.__progressFile(f))
+            if ref.getMd5() == md5:
+                orig = ref.toFingerprint()
+                break
+
+        if not compareOnly and (fp == None or fp.md5 != md5 or fp.partial != partial\
+                                or self.__hasFileChanged(info)):
+            self.__recordDigest(info, md5, partial)
+
+        fp = Fingerprint(f, self.path, md5, meta.mtimeNs, meta.size, partial)
+        return fp, orig
+
+    ## This function moves the files of the tree that are also in refDir to
+    #  the .dp/dups directory of their directory, with a symlink to the copy
+    #  in refDir in .dp/dups/origs
+    #  - The dups are first written to a plan in the .dp/plans directory of
+    #    this directory, see DupPlan. The plan is then executed one directory
+    #    at a time, so the moves of a directory are synced together.
+    #  - The plan records the fingerprints of the dups, so a removal can be
+    #    undone or reversed without hashing again, see undoRemoveDups and
+    #    reverseRemoveDups.
+    #  @param compareOnly - only write the plan. It can be executed later with
+    #                       executeRemoveDups.
+    #  @param onDemand - do not require fingerprints. Only files whose size is
+    #                    in refDir are hashed, see __findDupBySize.
+    #  @return path of the plan
+    def removeDups(self, refDir, compareOnly=False, onDemand=False):
         self.logger.info("removing dups with ref dir {}...".format(refDir.path))
-        dups = dict()
+        plan = DupPlan.create(os.path.join(self.privDir, "plans", Logger.Logger.newLogFileName() + ".jsonl"),
+                              self.path, refDir.path)
+
+        sizeIndex = refDir.__buildSizeIndex() if onDemand else None
+        n = self.__planRemoval(plan, refDir, compareOnly, sizeIndex)
+        plan.sync()
+        self.logger.info("{} dups found. plan: {}", n, plan.path)
 
-        # remove dups from sub directories
-        for subDir in self.subDirs:
+        if not compareOnly and n:
+            header, movesByDir, state = plan.read()
+            Directory.__executePlan(plan, movesByDir, state, Directory.__dirFactory([self]))
+        plan.close()
+
+        self.logger.info("remove dups done")
+        return plan.path
+
+    ## This function adds the dups of the tree to a remove-dups plan
+    #  @param sizeIndex - size index of refDir if hashing on demand
+    #  @return number of dups added
+    def __planRemoval(self, plan, refDir, compareOnly, sizeIndex):
+        n = 0
+        for subDir in self.__iterSubDirs():
             self.logger.info("removing dups from {}...".format(subDir.dirName))
-            subDir.removeDups(refDir, compareOnly)
+            n += subDir.__planRemoval(plan, refDir, compareOnly, sizeIndex)
 
-        # make a list of dups
         for f in self.fstatByName.keys():
-            self.logger.info("checking for {} in {}...".format(f, refDir.path))
-            fp = self.fpCache.getFpForFile(f)
-            orig = refDir.checkFile(fp)
+            self.logger.info("checking for {} in {}...", f, refDir.path)
+            if sizeIndex != None:
+                fp, orig = self.__findDupBySize(f, sizeIndex, compareOnly)
+            else:
+                fp = self.__getFullFp(f)
+                orig = refDir.checkFile(fp)
             if None != orig:
-                dups[f] = Directory.__DupInfo(f, fp, orig)
-
-        if not dups:
-            self.logger.info("no dups found")
-            return
-        else:
-            self.logger.debug("list of dups:")
-            for f, info in dups.iteritems():
-                self.logger.debug("{} is a dup of {}".format(info.fp.path, info.origFp.path))
+                self.logger.debug("{} is a dup of {}", fp.path, orig.path)
+                plan.add(self.__makeMove(fp, orig.path))
+                n += 1
 
-        if compareOnly:
-            self.logger.info("remove dups done")
-            return
+        # digests computed on demand
+        self.fpCache.flushCache()
+        return n
 
-        # remove dups
+    ## This function returns the plan record that moves a file of this
+    #  directory to .dp/dups and links it to its copy at origPath
+    def __makeMove(self, fp, origPath):
         dupsDir = os.path.join(self.privDir, "dups")
-        Directory.__createDirectory(dupsDir)
-        origsDir = os.path.join(dupsDir, "origs")
-        Directory.__createDirectory(origsDir)
-        for f, info in dups.iteritems():
-            self.logger.info("removing {}...".format(f))
-            # move file to dup/<filename>
-            os.rename(info.fp.path, os.path.join(dupsDir, f))
+        return {"op" : "move", "dir" : self.path, "file" : fp.file,
+                "dst" : os.path.join(dupsDir, fp.file),
+                "orig" : origPath, "link" : os.path.join(dupsDir, "origs", fp.file),
+                "md5" : fp.md5, "mtime" : fp.mtime, "size" : fp.size, "partial" : fp.partial}
+
+    ## This function returns a function that creates the Directory of a path
+    #  in a plan. Directories in one of the trees share its FPIndex.
+    #  @param trees - Directory objects of the roots of the trees
+    @staticmethod
+    def __dirFactory(trees):
+        def dirOf(path):
+            for tree in trees:
+                if tree.index != None\
+                        and (path == tree.path or path.startswith(os.path.join(tree.path, ""))):
+                    return Directory(path, index=tree.index)
+            return Directory(path)
+        return dirOf
+
+    ## This function opens the roots of a plan that are directories
+    #  @return list of Directory
+    @staticmethod
+    def __openTrees(*paths):
+        return [Directory(p) for p in paths if os.path.isdir(p)]
 
-            # add a symlink
-            os.symlink(info.origFp.path, os.path.join(origsDir, f))
+    @staticmethod
+    def __syncDir(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            with Stats.Timer("fsync"):
+                os.fsync(fd)
+            Stats.count("fsyncs")
+        finally:
+            os.close(fd)
+
+    ## This function executes the moves of a plan that are not done yet, one
+    #  directory at a time, and marks each directory done in the plan
+    @staticmethod
+    def __executePlan(plan, movesByDir, state, dirOf):
+        for dir, moves in movesByDir.iteritems():
+            if state.get(dir) == "done":
+                continue
+            dirOf(dir).__moveFiles(moves)
+            plan.mark("done", dir)
+
+    ## This function moves files of this directory as planned, see removeDups.
+    #  Moves that were already made by an interrupted run are skipped. The
+    #  directories changed are synced once all the files are moved.
+    def __moveFiles(self, moves):
+        changed = set([self.path])
+        for move in moves:
+            src = os.path.join(self.path, move["file"])
+            if os.path.lexists(src):
+                self.logger.info("removing {}...", move["file"])
+                Directory.__createDirectory(os.path.dirname(move["link"]))
+                os.rename(src, move["dst"])
+            elif not os.path.lexists(move["dst"]):
+                self.logger.warn("{} no longer exists, skipping it...", src)
+                continue
 
-            # remove from fingerprint from cache
-            self.fpCache.deleteFingerprint(info.fp)
+            if not os.path.lexists(move["link"]):
+                os.symlink(move["orig"], move["link"])
+            changed.update([os.path.dirname(move["dst"]), os.path.dirname(move["link"])])
 
-        # update FP DB
+            fp = self.fpCache.getFpForFile(move["file"])
+            if fp != None:
+                self.fpCache.deleteFingerprint(fp)
+                Stats.count("dupsRemoved")
+
+        for d in changed:
+            Directory.__syncDir(d)
         self.fpCache.flushCache()
 
-        self.logger.info("remove dups done")
+    ## This function moves the files of this directory back from .dp/dups,
+    #  undoing __moveFiles. Their fingerprints are restored from the plan.
+    def __restoreFiles(self, moves):
+        for move in reversed(moves):
+            src = os.path.join(self.path, move["file"])
+            if os.path.lexists(move["dst"]) and not os.path.lexists(src):
+                self.logger.info("restoring {}...", move["file"])
+                os.rename(move["dst"], src)
+                self.fpCache.addFingerprint(move["file"], move["md5"], move["mtime"],
+                                            move["size"], move["partial"])
+                Stats.count("dupsRestored")
+            if os.path.islink(move["link"]):
+                os.remove(move["link"])
+
+        Directory.__syncDir(self.path)
+        self.fpCache.flushCache()
 
-    def __addFilesToHash(self, hash):
-        # pass it down to sub dirs first
-        [subdir.__addFilesToHash(hash) for subdir in self.subDirs]
+    ## This function executes a remove-dups plan written with compareOnly, or
+    #  the rest of a plan whose run was interrupted
+    @staticmethod
+    def executeRemoveDups(planPath):
+        plan = DupPlan(planPath)
+        header, movesByDir, state = plan.read()
+        trees = Directory.__openTrees(header["root"])
+        Directory.__executePlan(plan, movesByDir, state, Directory.__dirFactory(trees))
+        plan.close()
+
+    ## This function undoes a remove-dups run: the dups are moved back, their
+    #  links removed and their fingerprints restored, directory by directory
+    #  in the reverse order of the removal
+    #  @return the header and moves of the plan, see DupPlan.read
+    @staticmethod
+    def undoRemoveDups(planPath):
+        plan = DupPlan(planPath)
+        header, movesByDir, state = plan.read()
+        dirOf = Directory.__dirFactory(Directory.__openTrees(header["root"]))
+        for dir in reversed(movesByDir.keys()):
+            if state.get(dir) == "undone":
+                continue
+            if not os.path.isdir(dir):
+                raise Exception(dir + " no longer exists, can not undo " + plan.path)
+            dirOf(dir).__restoreFiles(movesByDir[dir])
+            plan.mark("undone", dir)
+        plan.close()
+        return header, movesByDir
+
+    ## This function reverses the direction of a remove-dups run: the dups are
+    #  moved back and the copies they were dups of are removed from the
+    #  reference tree instead, the same way removeDups removes them. Neither
+    #  tree is hashed again.
+    #  @return path of the plan of the reversed run
+    @staticmethod
+    def reverseRemoveDups(planPath):
+        header, movesByDir = Directory.undoRemoveDups(planPath)
+        trees = Directory.__openTrees(header["ref"], header["root"])
+        if not trees:
+            raise Exception("can not reverse {}: neither {} nor {} exists"\
+                            .format(planPath, header["ref"], header["root"]))
+        dirOf = Directory.__dirFactory(trees)
+        logger = trees[-1].logger
+
+        plan = DupPlan.create(os.path.splitext(os.path.abspath(planPath))[0] + ".reverse.jsonl",
+                              header["ref"], header["root"])
+        dirs = dict()
+        seen = set()
+        for moves in movesByDir.itervalues():
+            for move in moves:
+                orig = move["orig"]
+                if orig in seen:
+                    continue
+                seen.add(orig)
+                if not os.path.isfile(orig):
+                    logger.warn("{} no longer exists, skipping it...", orig)
+                    continue
 
+                origDir, file = os.path.split(orig)
+                d = dirs.get(origDir)
+                if d == None:
+                    d = dirs[origDir] = dirOf(origDir)
+                fp = d.fpCache.getFpForFile(file)
+                if fp == None:
+                    # the copy has the same contents as the dup
+                    fp = Fingerprint(file, origDir, move["md5"], mtimeNs(os.stat(orig)),
+                                     move["size"], move["partial"])
+                plan.add(d.__makeMove(fp, os.path.join(move["dir"], move["file"])))
+        plan.sync()
+        logger.info("reversing {} removals. plan: {}", len(seen), plan.path)
+
+        header, movesByDir, state = plan.read()
+        Directory.__executePlan(plan, movesByDir, state, dirOf)
+        plan.close()
+        return plan.path
+
+    ## This function collects the paths of the files in the tree by digest
+    #  @param skip - function(path) returning True for sub directories whose
+    #                files are left out
+    def __addFilesToHash(self, hash, skip=None):
+        # sub dirs first
+        for d in self.__walk(False, skip):
+            d.__addOwnFilesToHash(hash)
+
+    ## This function logs a warning if digests of more than one algorithm are
+    #  compared, as files hashed with different algorithms never match. Large
+    #  files are hashed in chunks, with an algorithm of their own, so digests
+    #  are only compared with those of files that would be hashed the same way,
+    #  see Hasher.algorithmFor.
+    #  @return dict of the algorithm new digests are made with -> set of the
+    #          algorithms of the digests of the files it applies to
+    def __warnMixedAlgorithms(self, hash):
+        algorithmsByScheme = dict()
+        for fps in hash.itervalues():
+            fp = fps[0] if isinstance(fps, list) else fps
+            algorithmsByScheme.setdefault(Hasher.algorithmFor(fp.size), set())\
+                              .add(Hasher.algorithmOf(fp.md5))
+
+        algorithms = set(a for s in algorithmsByScheme.itervalues() if len(s) > 1 for a in s)
+        if algorithms:
+            self.logger.warn("digests of more than one algorithm found ({}), some dups may be missed. "\
+                             "fingerprint with --upgrade-digests to use one algorithm"\
+                             .format(", ".join(sorted(algorithms))))
+        return algorithmsByScheme
+
+    def __addOwnFilesToHash(self, hash):
         for f in self.fstatByName.keys():
             fp = self.fpCache.getFpForFile(f)
             if None == fp:
                 raise Exception("directory {} needs to be fingerprinted".format(self.path))
 
-            if fp.md5 not in hash:
-                hash[fp.md5] = [fp.path]
-            else:
-                hash[fp.md5].append(fp.path)
+            # files without a full digest have a unique size or partial digest
+            # in the tree
+            if not fp.md5:
+                continue
+
+            Directory.__addToDigestMap(hash, fp)
+
+    def __logDupLists(self, hash):
+        for md5, fps in hash.iteritems():
+            if isinstance(fps, list):
+                self.logger.info(", ".join(fp.path for fp in fps))
 
     def checkForInternalDups(self):
         self.logger.info("checking for internal dups...")
         # collect all the hashes by file and check for hashes that have more than one file
         md5Hash = dict()
         self.__addFilesToHash(md5Hash)
+        self.__warnMixedAlgorithms(md5Hash)
 
         self.logger.info("list of dups:")
-        for md5, files in md5Hash.iteritems():
-            if len(files) > 1:
-                msg = ""
-                firstDone = False
-                for f in files:
-                    if not firstDone:
-                        msg = f
-                        firstDone = True
+        self.__logDupLists(md5Hash)
+
+        self.logger.info("internal dup check done")
+
+    ## This function replaces the duplicate files in the tree with links to the
+    #  first copy of each file in walk order, so that their data is stored once.
+    #  - Files are matched by full digest. Files that changed since they were
+    #    fingerprinted and files on another device than the first copy are
+    #    left alone.
+    #  - The link is made under a temporary name and renamed over the
+    #    duplicate, so the duplicate is never missing.
+    #  - The fingerprints of the linked files are updated with their new stat,
+    #    once per directory, so the tree does not need to be fingerprinted
+    #    again.
+    #  @param method - "hardlink" or "reflink". Hard linked files share their
+    #                  metadata and changes to their content; reflinked files
+    #                  only share their data on disk until one is modified.
+    #  @param verify - compare the files byte by byte before linking them
+    #  @param dryRun - only log the files that would be linked
+    def linkInternalDups(self, method="hardlink", verify=False, dryRun=False):
+        if self.checkMode:
+            raise Exception("linking is not allowed in check mode")
+        if method not in ("hardlink", "reflink"):
+            raise Exception("unknown link method {}".format(method))
+
+        self.logger.info("linking internal dups...")
+
+        # packed digest -> (Fingerprint, FileMeta) of the copy that is kept
+        origs = dict()
+        # directory -> list of (file, path of the copy it is linked to)
+        links = dict()
+        for d in self.__walk(True):
+            for f, info in d.fstatByName.iteritems():
+                fp = d.fpCache.getFpForFile(f)
+                if None == fp:
+                    raise Exception("directory {} needs to be fingerprinted".format(d.path))
+                if not fp.md5:
+                    continue
+                if d.__hasFileChanged(info):
+                    d.logger.warn("{} changed since it was fingerprinted, skipping...", f)
+                    continue
+
+                meta = info.stat()
+                key = Hasher.packDigest(fp.md5)
+                if key not in origs:
+                    origs[key] = (fp, meta)
+                    continue
+
+                origFp, origMeta = origs[key]
+                origPath = origFp.path
+                if (meta.ino, meta.dev) == (origMeta.ino, origMeta.dev):
+                    continue
+                if meta.dev != origMeta.dev:
+                    d.logger.info("{} is a dup of {} on another device, skipping...", f, origPath)
+                    continue
+                links.setdefault(d.path, []).append((f, origPath))
+        origs = None
+
+        for d in self.__walk(True):
+            if not links:
+                break
+            if d.path in links:
+                d.__linkFiles(links.pop(d.path), method, verify, dryRun)
+
+        self.logger.info("linking internal dups done")
+
+    def __linkFiles(self, files, method, verify, dryRun):
+        # the fingerprints of the files already linked are kept if linking
+        # a file fails
+        try:
+            for f, origPath in files:
+                path = os.path.join(self.path, f)
+                if verify and not filecmp.cmp(origPath, path, shallow=False):
+                    self.logger.warn("{} has the same digest as {} but a different content, skipping...",\
+                                     f, origPath)
+                    continue
+
+                self.logger.info("linking {} to {}...", f, origPath)
+                if dryRun:
+                    continue
+
+                tmpPath = os.path.join(self.path, ".dp_link." + f)
+                try:
+                    if method == "hardlink":
+                        os.link(origPath, tmpPath)
                     else:
-                        msg = msg + ", " + f
+                        Copier.reflinkFile(origPath, tmpPath)
+                        shutil.copystat(path, tmpPath)
+                    os.rename(tmpPath, path)
+                except (OSError, IOError) as e:
+                    if os.path.lexists(tmpPath):
+                        os.remove(tmpPath)
+                    raise Exception("unable to {} {} to {}: {}".format(method, f, origPath, e))
+
+                st = os.stat(path)
+                fp = self.fpCache.getFpForFile(f)
+                self.fpCache.addFingerprint(f, fp.md5, mtimeNs(st), st.st_size, fp.partial)
+                Stats.count("filesLinked")
+                Stats.count("bytesReclaimed", st.st_size)
+        finally:
+            self.fpCache.flushCache()
 
-                self.logger.info(msg)
+    ## This function reports directories whose whole subtrees are duplicates of
+    #  each other and then reports duplicate files outside of those subtrees.
+    #  - Merkle digests are computed bottom up from the fingerprint caches, so
+    #    no file is read. Empty directories are not reported.
+    #  - Groups of duplicate directories are reported highest level first. The
+    #    first directory of a group is kept and the subtrees of the others are
+    #    left out of all further comparisons.
+    def checkForDupDirs(self):
+        self.logger.info("checking for duplicate directories...")
+
+        emptyMerkle = hashlib.md5().hexdigest()
+        merkles = dict()
+        dirsByMerkle = dict()
+        for d in self.__walk():
+            merkle = d.__makeMerkle(merkles)
+            if merkle == "" and d.fstatByName:
+                raise Exception("directory {} needs to be fingerprinted without --size-prefilter"\
+                                .format(d.path))
+            merkles[d.path] = merkle
+            if merkle and merkle != emptyMerkle and d is not self:
+                dirsByMerkle.setdefault(merkle, []).append(d.path)
+
+        # a directory is a dup if it is in a group of more than one, starting
+        # with the groups closest to the root
+        groups = [sorted(paths, key=lambda p: (p.count(os.sep), p))\
+                  for paths in dirsByMerkle.itervalues() if len(paths) > 1]
+        groups.sort(key=lambda paths: (paths[0].count(os.sep), paths[0]))
+
+        dupDirs = set()
+        def isUnderDupDir(path):
+            while path != self.path and path != os.path.dirname(path):
+                if path in dupDirs:
+                    return True
+                path = os.path.dirname(path)
+            return False
+
+        self.logger.info("list of duplicate directories:")
+        for paths in groups:
+            paths = [p for p in paths if not isUnderDupDir(p)]
+            if len(paths) < 2:
+                continue
 
-        self.logger.info("internal dup check done")
+            self.logger.info(", ".join(paths))
+            dupDirs.update(paths[1:])
+
+        # compare the remaining files
+        md5Hash = dict()
+        self.__addFilesToHash(md5Hash, lambda p: p in dupDirs)
+        self.__warnMixedAlgorithms(md5Hash)
+
+        self.logger.info("list of dups outside duplicate directories:")
+        self.__logDupLists(md5Hash)
+
+        self.logger.info("duplicate directory check done")
 
     ## This function copies over the srcFile to current directory and then adds
-    #  the fingerprint to cache
+    #  the fingerprint to cache. The copy keeps the modify time of srcFile and
+    #  its fingerprint is recorded with the stat of the copy, so it is not
+    #  hashed again by the next fingerprint run.
     #  @param srcFile - Fully qualified path to the source file.
     #  @param srcFileFP - Source file fingerprint
-    def __copyFile(self, srcFile, srcFileFP):
-        # move the file on disk
-        copyfile(srcFile, os.path.join(self.path, os.path.basename(srcFile)))
+    #  @param copier - Copier the copy is queued on
+    def __copyFile(self, srcFile, srcFileFP, copier):
+        fpCache = self.fpCache
+        def done(st):
+            fpCache.addFingerprint(srcFileFP.file, srcFileFP.md5, mtimeNs(st), st.st_size,\
+                                   srcFileFP.partial)
 
-        # add FP to cache
-        self.fpCache.addFingerprint(srcFileFP.file, srcFileFP.md5, time.time(), srcFileFP.size)
+        copier.submit(srcFile, os.path.join(self.path, os.path.basename(srcFile)), done)
 
     ## This function compares files in the current directory against the
     #  the reference directory and then copies unique files over to the specified
@@ -500,25 +1842,37 @@ class Directory:
     #                  the current directory will be checked against refDir to
     #                  check if they are uinque.
     #  @param dst    - Directory object for destination directory. 
-    def copyUniques(self, refDir, dst):
+    #  @param jobs   - number of files to copy concurrently
+    #  @param copier - Copier to queue the copies on. a new one is used if None.
+    def copyUniques(self, refDir, dst, jobs=1, copier=None):
+        if copier == None:
+            copier = Copier.Copier(jobs)
+            try:
+                self.copyUniques(refDir, dst, jobs, copier)
+            finally:
+                copier.close()
+            return
+
         self.logger.info("copying unique files to {} with reference dir {}".format(dst.path, refDir.path))
         # move uniques from sub dirs first
-        for subDir in self.subDirs:
+        for subDir in self.__iterSubDirs():
             self.logger.info("copying unique files from {}...".format(subDir.dirName))
             p = os.path.join(dst.path, subDir.dirName)
             if not os.path.isdir(p):
                 Directory.__createDirectory(p)
-            d = Directory(p)
-            subDir.copyUniques(refDir, d)
+            d = Directory(p, index=dst.index)
+            subDir.copyUniques(refDir, d, jobs, copier)
 
         # copy unique files
         for f in self.fstatByName.keys():
-            fp = self.fpCache.getFpForFile(f)
+            fp = self.__getFullFp(f)
             orig = refDir.checkFile(fp)
             if None == orig:
-                self.logger.info("{} is unique".format(f))
-                dst.__copyFile(os.path.join(self.path, f), fp)
+                self.logger.info("{} is unique", f)
+                dst.__copyFile(os.path.join(self.path, f), fp, copier)
             else:
-                self.logger.info("{} is a dup of {}".format(f, orig.path))
+                self.logger.info("{} is a dup of {}", f, orig.path)
 
+        # the fingerprints of the copies are written once they are all done
+        copier.then(dst.fpCache.flushCache)
         self.logger.info("copying unique files done")
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import collections
+
+import Stats
+
+## The plan of a remove-dups run, in JSON lines
+#  - The first line describes the run:
+#      {"op": "plan", "root": <candidate tree>, "ref": <reference>, "time": <seconds>}
+#  - Each dup found is a "move" record, written before any file is moved:
+#      {"op": "move", "dir": <directory of the dup>, "file": <dup>,
+#       "dst": <path it is moved to>, "orig": <path of the copy in the reference>,
+#       "link": <path of the symlink to orig>, "md5", "mtime", "size", "partial"}
+#    The fingerprint fields are those of the dup, so it can be put back
+#    without hashing it again.
+#  - Once the moves of a directory are done and synced, {"op": "done", "dir"}
+#    is appended, and {"op": "undone", "dir"} once they are undone. The plan
+#    is thus also the journal of the run.
+#  - File names are bytes. Records with names that are not UTF-8 are written
+#    as Latin-1 and have "encoding": "latin-1".
+class DupPlan:
+    ## Constructor
+    #  @param path - path to the plan file. It is created if it does not exist.
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.__fh = None
+
+    ## This function starts a new plan. If path exists, a number is added to
+    #  the name of the new plan.
+    @staticmethod
+    def create(path, root, ref):
+        dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+        base, ext = os.path.splitext(path)
+        n = 0
+        while os.path.exists(path):
+            n += 1
+            path = "{}-{}{}".format(base, n, ext)
+
+        plan = DupPlan(path)
+        plan.add({"op" : "plan", "root" : root, "ref" : ref, "time" : time.time()})
+        return plan
+
+    ## This function appends a record to the plan. Records are only on disk
+    #  once the plan is synced.
+    def add(self, record):
+        if self.__fh == None:
+            self.__fh = open(self.path, "a")
+        try:
+            line = json.dumps(record, sort_keys=True)
+        except UnicodeDecodeError:
+            record = dict(record, encoding="latin-1")
+            line = json.dumps(record, sort_keys=True, encoding="latin-1")
+        self.__fh.write(line + "\n")
+
+    def sync(self):
+        if self.__fh != None:
+            self.__fh.flush()
+            with Stats.Timer("fsync"):
+                os.fsync(self.__fh.fileno())
+            Stats.count("fsyncs")
+
+    ## This function appends a record for a directory and syncs the plan
+    #  @param op - "done" or "undone"
+    def mark(self, op, dir):
+        self.add({"op" : op, "dir" : dir})
+        self.sync()
+
+    def close(self):
+        if self.__fh != None:
+            self.__fh.close()
+            self.__fh = None
+
+    @staticmethod
+    def __decode(record):
+        encoding = record.pop("encoding", "utf-8")
+        return dict((str(k), v.encode(encoding) if isinstance(v, unicode) else v)
+                    for k, v in record.iteritems())
+
+    ## This function reads the plan
+    #  @return (header record, OrderedDict of directory -> list of move
+    #          records, dict of directory -> its last "done" or "undone" op)
+    def read(self):
+        header = None
+        movesByDir = collections.OrderedDict()
+        state = dict()
+        with open(self.path, "r") as fh:
+            for line in fh:
+                if not line.endswith("\n"):
+                    # torn by an interrupted run
+                    break
+                record = DupPlan.__decode(json.loads(line))
+                if record["op"] == "plan":
+                    header = record
+                elif record["op"] == "move":
+                    movesByDir.setdefault(record["dir"], []).append(record)
+                else:
+                    state[record["dir"]] = record["op"]
+
+        if header == None:
+            raise Exception("{} is not a remove-dups plan".format(self.path))
+        return header, movesByDir, state
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+import os.path
+import sqlite3
+import Stats
+
+## A single fingerprint store for a whole directory tree
+#  - Replaces the per directory .dp/fpDB.txt files with one SQLite database in
+#    the .dp directory of the root of the tree.
+#  - Fingerprints are keyed by the path of their directory relative to the root
+#    and the file name. Digests and sizes are indexed for lookups across the
+#    whole tree.
+#  - The schema version is kept in the user_version pragma and older indexes
+#    are upgraded when they are opened.
+#  - The database runs in WAL mode and every directory is written in its own
+#    transaction, so an interrupted run keeps the directories already written.
+class FPIndex:
+    FILE_NAME = "fpIndex.db"
+    SCHEMA_VERSION = 1
+
+    ## Constructor
+    #  @param path - fully qualified path to the database file
+    #  @param root - the directory (work directory) the relative paths are
+    #                relative to
+    def __init__(self, path, root):
+        self.path = path
+        self.root = os.path.abspath(root)
+
+        self.__conn = sqlite3.connect(path)
+        # file names are kept as byte strings
+        self.__conn.text_factory = str
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+
+        version = self.__conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > FPIndex.SCHEMA_VERSION:
+            raise Exception("{} was written by a newer version of dup_finder".format(path))
+
+        with self.__conn:
+            if version < 1:
+                self.__upgradeMtimes()
+            else:
+                self.__createTables()
+            self.__conn.execute("PRAGMA user_version = {}".format(FPIndex.SCHEMA_VERSION))
+
+    def __createTables(self):
+        # modify times are nanoseconds, or float seconds for fingerprints
+        # recorded before nanosecond modify times. The columns have no type
+        # affinity, so SQLite keeps integers and floats as they are given.
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS fingerprints ("
+                            "dir TEXT NOT NULL, "
+                            "file TEXT NOT NULL, "
+                            "md5 TEXT NOT NULL, "
+                            "mtime BLOB NOT NULL, "
+                            "size INTEGER NOT NULL, "
+                            "partial TEXT NOT NULL, "
+                            "PRIMARY KEY (dir, file))")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS fpByMd5 ON fingerprints (md5)")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS fpBySize ON fingerprints (size)")
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS stamps ("
+                            "dir TEXT PRIMARY KEY, "
+                            "mtime BLOB NOT NULL, "
+                            "count INTEGER NOT NULL, "
+                            "rollup TEXT NOT NULL)")
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS merkles ("
+                            "dir TEXT PRIMARY KEY, "
+                            "merkle TEXT NOT NULL)")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS dirByMerkle ON merkles (merkle)")
+
+    ## This function moves the tables of an index made before nanosecond
+    #  modify times, whose REAL mtime columns would round nanoseconds, to
+    #  tables without type affinity. The old rows keep their float seconds.
+    def __upgradeMtimes(self):
+        tables = [name for (name,) in self.__conn.execute("SELECT name FROM sqlite_master "
+                                                          "WHERE type = 'table'")]
+        # an upgrade that was interrupted is picked up where it stopped
+        old = [t for t in ("fingerprints", "stamps") if t in tables or "old_" + t in tables]
+        for table in old:
+            if "old_" + table not in tables:
+                self.__conn.execute("ALTER TABLE {0} RENAME TO old_{0}".format(table))
+        # indexes follow their table when it is renamed
+        self.__conn.execute("DROP INDEX IF EXISTS fpByMd5")
+        self.__conn.execute("DROP INDEX IF EXISTS fpBySize")
+
+        self.__createTables()
+        for table in old:
+            self.__conn.execute("INSERT OR REPLACE INTO {0} SELECT * FROM old_{0}".format(table))
+            self.__conn.execute("DROP TABLE old_{}".format(table))
+
+    def close(self):
+        if self.__conn != None:
+            self.__conn.close()
+            self.__conn = None
+
+    ## This function returns the key for a directory in the tree
+    def relPath(self, dir):
+        return os.path.relpath(os.path.abspath(dir), self.root)
+
+    ## This function returns the absolute path of a directory key
+    def absPath(self, relDir):
+        return os.path.normpath(os.path.join(self.root, relDir))
+
+    ## This function returns the fingerprints of a directory
+    #  @return list of (file, md5, mtime, size, partial)
+    def readDir(self, dir):
+        return self.__conn.execute("SELECT file, md5, mtime, size, partial "
+                                   "FROM fingerprints WHERE dir = ?",
+                                   (self.relPath(dir),)).fetchall()
+
+    ## This function returns the stamp of a directory
+    #  @return (mtime, count, rollup) or None if the directory has no stamp
+    def readStamp(self, dir):
+        return self.__conn.execute("SELECT mtime, count, rollup FROM stamps WHERE dir = ?",
+                                   (self.relPath(dir),)).fetchone()
+
+    ## This function returns the Merkle digest of a directory
+    #  @return the digest or an empty string if the directory has none
+    def readMerkle(self, dir):
+        row = self.__conn.execute("SELECT merkle FROM merkles WHERE dir = ?",
+                                  (self.relPath(dir),)).fetchone()
+        return row[0] if row != None else ""
+
+    ## This function replaces the fingerprints of a directory
+    #  @param fps - iterable of Fingerprint objects
+    #  @param stamp - DirStamp of the directory, if any
+    #  @param merkle - Merkle digest of the directory, if any
+    def writeDir(self, dir, fps, stamp=None, merkle=""):
+        relDir = self.relPath(dir)
+        Stats.count("indexWrites")
+        with Stats.Timer("index write"), self.__conn:
+            self.__conn.execute("DELETE FROM fingerprints WHERE dir = ?", (relDir,))
+            self.__conn.executemany("INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)",
+                                    ((relDir, fp.file, fp.md5, fp.mtime, fp.size, fp.partial)
+                                     for fp in fps))
+            self.__conn.execute("DELETE FROM stamps WHERE dir = ?", (relDir,))
+            if stamp != None:
+                self.__conn.execute("INSERT INTO stamps VALUES (?, ?, ?, ?)",
+                                    (relDir, stamp.mtime, stamp.count, stamp.rollup))
+            self.__conn.execute("DELETE FROM merkles WHERE dir = ?", (relDir,))
+            if merkle:
+                self.__conn.execute("INSERT INTO merkles VALUES (?, ?)", (relDir, merkle))
+
+    ## This function removes the fingerprints of a directory and of its
+    #  subtree, e.g. after it was deleted
+    def removeTree(self, dir):
+        relDir = self.relPath(dir)
+        prefix = relDir + os.sep
+        with self.__conn:
+            for table in ["fingerprints", "stamps", "merkles"]:
+                self.__conn.execute("DELETE FROM {} WHERE dir = ? OR substr(dir, 1, ?) = ?"
+                                    .format(table), (relDir, len(prefix), prefix))
+
+    ## This function copies the directories of another index of the same tree
+    #  over those of this one, e.g. the partial index of a shard
+    #  @return list of the directory keys copied
+    def mergeFrom(self, path):
+        self.__conn.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            with Stats.Timer("index write"), self.__conn:
+                dirs = [(d,) for (d,) in self.__conn.execute("SELECT dir FROM other.fingerprints UNION "
+                                                             "SELECT dir FROM other.stamps UNION "
+                                                             "SELECT dir FROM other.merkles")]
+                for table in ["fingerprints", "stamps", "merkles"]:
+                    self.__conn.executemany("DELETE FROM {} WHERE dir = ?".format(table), dirs)
+                    self.__conn.execute("INSERT INTO {0} SELECT * FROM other.{0}".format(table))
+        finally:
+            self.__conn.execute("DETACH DATABASE other")
+        return [d for (d,) in dirs]
+
+    ## This function removes the fingerprints of directories that are no
+    #  longer in the tree
+    #  @param dirs - all the directories currently in the tree
+    def pruneDirs(self, dirs):
+        live = set(self.relPath(d) for d in dirs)
+        stale = [(d,) for (d,) in self.__conn.execute("SELECT dir FROM fingerprints UNION "
+                                                      "SELECT dir FROM stamps UNION "
+                                                      "SELECT dir FROM merkles")
+                 if d not in live]
+        if stale:
+            with self.__conn:
+                self.__conn.executemany("DELETE FROM fingerprints WHERE dir = ?", stale)
+                self.__conn.executemany("DELETE FROM stamps WHERE dir = ?", stale)
+                self.__conn.executemany("DELETE FROM merkles WHERE dir = ?", stale)
+        return len(stale)
+
+    ## This function finds all the files in the tree with the given digest
+    #  @return list of (absolute dir path, file, md5, mtime, size, partial)
+    def lookupMd5(self, md5):
+        return [(self.absPath(r[0]),) + r[1:] for r in
+                self.__conn.execute("SELECT dir, file, md5, mtime, size, partial "
+                                    "FROM fingerprints WHERE md5 = ?", (md5,))]
+
+    ## This function finds all the files in the tree with the given size
+    #  @return list of (absolute dir path, file, md5, mtime, size, partial)
+    def lookupSize(self, size):
+        return [(self.absPath(r[0]),) + r[1:] for r in
+                self.__conn.execute("SELECT dir, file, md5, mtime, size, partial "
+                                    "FROM fingerprints WHERE size = ?", (size,))]
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+import os
+import binascii
+import hashlib
+import threading
+import ctypes
+import ctypes.util
+import Stats
+from multiprocessing.pool import ThreadPool
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+## Supported digest algorithms
+ALGORITHMS = {
+    "md5" : hashlib.md5,
+    "sha1" : hashlib.sha1,
+    "blake2b" : blake2b,
+    }
+
+## Digest algorithm used for new digests. Digests are stored as
+#  "<algorithm>:<hex digest>", except for md5 digests which are stored as plain
+#  hex digests so that existing fingerprint databases stay valid.
+algorithm = "md5"
+
+# size of each read when hashing a file
+BUF_SIZE = 1024 * 1024
+
+# number of bytes read from each end of a file for the partial digest
+PARTIAL_HASH_BYTES = 65536
+
+# files larger than this are hashed in chunks, see hashFile. The digests of
+# such files depend on both sizes, so changing them makes the digests of
+# large files incomparable with the ones already recorded.
+CHUNKED_MIN_SIZE = 1024 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024 * 1024
+
+# access patterns for posix_fadvise
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+## _fadvise(fd, advice) tells the kernel how a file will be read. It is only
+#  a hint, so failures are ignored.
+if hasattr(os, "posix_fadvise"):
+    def _fadvise(fd, advice):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+else:
+    _libcFadvise = None
+    try:
+        _libcFadvise = ctypes.CDLL(ctypes.util.find_library("c") or None).posix_fadvise
+        _libcFadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    except (OSError, AttributeError):
+        pass
+
+    def _fadvise(fd, advice):
+        if _libcFadvise != None:
+            _libcFadvise(fd, 0, 0, advice)
+
+## This function selects the digest algorithm and the read size for new digests
+def configure(algo=None, bufSize=None):
+    global algorithm, BUF_SIZE
+
+    if algo != None:
+        if algo not in ALGORITHMS:
+            raise Exception("unknown digest algorithm {}. supported algorithms: {}"\
+                            .format(algo, ", ".join(sorted(ALGORITHMS.keys()))))
+        if ALGORITHMS[algo] == None:
+            raise Exception("{} is not available. install pyblake2".format(algo))
+        algorithm = algo
+
+    if bufSize != None:
+        if bufSize < 4096:
+            raise Exception("read size must be at least 4096 bytes")
+        BUF_SIZE = bufSize
+
+## This function returns the algorithm of a stored digest. Digests of files
+#  hashed in chunks are "<algorithm>-c<chunk MiB>:<hex digest>" and
+#  "<algorithm>-c<chunk MiB>" is their algorithm, as they never match a digest
+#  of the whole file.
+def algorithmOf(digest):
+    if ":" in digest:
+        return digest.split(":", 1)[0]
+    return "md5"
+
+## This function returns the algorithm new digests of a file of the given
+#  size are made with, see algorithmOf
+def algorithmFor(size):
+    if size > CHUNKED_MIN_SIZE:
+        return "{}-c{}".format(algorithm, CHUNK_SIZE >> 20)
+    return algorithm
+
+## This function returns a stored digest in binary form, for in memory
+#  indexes of large trees. The hex part of the digest is packed, so an md5
+#  digest takes 16 bytes instead of 32 characters.
+def packDigest(digest):
+    algo, sep, hexDigest = digest.rpartition(":")
+    try:
+        return algo + sep + binascii.unhexlify(hexDigest)
+    except (TypeError, binascii.Error):
+        return digest
+
+## This function returns the stored form of a digest packed by packDigest
+def unpackDigest(packed):
+    if len(packed) == 16:
+        return binascii.hexlify(packed)
+    algo, sep, raw = packed.partition(":")
+    return algo + sep + binascii.hexlify(raw)
+
+def _digestKey(h):
+    if algorithm == "md5":
+        return h.hexdigest()
+    return algorithm + ":" + h.hexdigest()
+
+def _chunkedDigestKey(h):
+    return "{}:{}".format(algorithmFor(CHUNKED_MIN_SIZE + 1), h.hexdigest())
+
+# read buffers are reused by each hashing thread
+_buffers = threading.local()
+
+def _getBuffer():
+    buf = getattr(_buffers, "buf", None)
+    if buf == None or len(buf) != BUF_SIZE:
+        buf = bytearray(BUF_SIZE)
+        _buffers.buf = buf
+        _buffers.view = memoryview(buf)
+    return buf, _buffers.view
+
+## This function feeds up to size bytes of f (all of it if size is None) to h.
+#  Data is read into a reusable buffer instead of a new string per read.
+#  @return number of bytes read
+def _update(h, f, size=None):
+    buf, view = _getBuffer()
+    total = 0
+    while size == None or size > 0:
+        n = f.readinto(buf if size == None or size >= len(buf) else view[:size])
+        if not n:
+            break
+
+        h.update(view[:n])
+        total += n
+        if size != None:
+            size -= n
+    return total
+
+## This function reads the chunk digests saved by an interrupted run
+#  @param header - identifies the file and the way it is hashed. Saved
+#                  digests with another header are discarded.
+def _readProgress(progressFile, header):
+    try:
+        with open(progressFile, "r") as fh:
+            lines = fh.read().split("\n")
+    except IOError:
+        return []
+
+    if not lines or lines[0] != header:
+        return []
+    # the last line is empty, or torn if the run was interrupted while
+    # writing it
+    return lines[1:-1]
+
+def _openProgress(progressFile, header, chunks):
+    dir = os.path.dirname(progressFile)
+    try:
+        os.makedirs(dir)
+    except OSError:
+        if not os.path.isdir(dir):
+            raise
+
+    fh = open(progressFile, "w")
+    fh.write(header + "\n")
+    for chunk in chunks:
+        fh.write(chunk + "\n")
+    return fh
+
+## This function hashes a file chunk by chunk. The digest is the digest of
+#  the list of chunk digests. Each chunk digest is saved to progressFile as
+#  soon as it is computed, so an interrupted run resumes after the last
+#  saved chunk. progressFile is removed once the file is hashed.
+#  @return digest and number of bytes read
+def _hashChunked(f, progressFile):
+    st = os.fstat(f.fileno())
+    header = "{}|{!r}|{}|{}".format(st.st_size, st.st_mtime, algorithm, CHUNK_SIZE)
+    chunks = _readProgress(progressFile, header) if progressFile != None else []
+    if chunks:
+        Stats.count("chunksResumed", len(chunks))
+    f.seek(len(chunks) * CHUNK_SIZE)
+
+    fh = _openProgress(progressFile, header, chunks) if progressFile != None else None
+    read = 0
+    try:
+        while len(chunks) * CHUNK_SIZE < st.st_size:
+            h = ALGORITHMS[algorithm]()
+            n = _update(h, f, CHUNK_SIZE)
+            if not n:
+                break
+            read += n
+            chunks.append(h.hexdigest())
+
+            if fh != None:
+                fh.write(chunks[-1] + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+    finally:
+        if fh != None:
+            fh.close()
+
+    h = ALGORITHMS[algorithm]()
+    for chunk in chunks:
+        h.update(chunk)
+    if progressFile != None:
+        os.remove(progressFile)
+    return _chunkedDigestKey(h), read
+
+## This function computes the full digest of a file. Files larger than
+#  CHUNKED_MIN_SIZE are hashed in chunks, see _hashChunked.
+#  The file is read once, so the kernel is asked to read ahead and to drop
+#  its pages from the cache afterwards, rather than evicting other data.
+#  @param progressFile - file the progress of a chunked hash is saved to.
+#                        If None, an interrupted hash starts over.
+def hashFile(file, progressFile=None):
+    with Stats.Timer("hash"):
+        with open(file, 'rb', 0) as f:
+            _fadvise(f.fileno(), POSIX_FADV_SEQUENTIAL)
+            if os.fstat(f.fileno()).st_size > CHUNKED_MIN_SIZE:
+                digest, n = _hashChunked(f, progressFile)
+            else:
+                h = ALGORITHMS[algorithm]()
+                n = _update(h, f)
+                digest = _digestKey(h)
+            _fadvise(f.fileno(), POSIX_FADV_DONTNEED)
+
+    Stats.count("filesHashed")
+    Stats.count("bytesHashed", n)
+    return digest
+
+## This function computes the digest of the head and the tail of a file.
+#  Files that are no larger than the head and tail put together are read
+#  completely, so their partial digest is the same as their full digest.
+def partialHashFile(file, size):
+    n = PARTIAL_HASH_BYTES
+    h = ALGORITHMS[algorithm]()
+
+    with Stats.Timer("hash"):
+        with open(file, 'rb', 0) as f:
+            if size <= 2 * n:
+                read = _update(h, f)
+            else:
+                read = _update(h, f, n)
+                f.seek(-n, os.SEEK_END)
+                read += _update(h, f, n)
+
+    Stats.count("partialsHashed")
+    Stats.count("bytesHashed", read)
+    return _digestKey(h)
+
+## Result of a call done inline
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+## A pool of hashing workers
+#  - Work is handed out to a pool of threads. Reads and digest updates release
+#    the GIL, so threads are enough to keep several disks/cores busy.
+#  - Results are collected by the caller, so they can be applied
+#    deterministically from a single thread.
+#  - With one job no threads are created and the work is done inline.
+class HashPool:
+    ## Constructor
+    #  @param jobs - number of files to hash concurrently
+    def __init__(self, jobs=1):
+        if jobs < 1:
+            raise Exception("number of jobs must be at least 1")
+
+        self.jobs = jobs
+        # number of files callers keep submitted ahead of the results they wait for
+        self.window = 4 * jobs
+        self.__pool = ThreadPool(jobs) if jobs > 1 else None
+
+    ## This function calls func with args on the pool
+    #  @param meta - FileMeta of the file hashed. Only used by IOScheduler.
+    #  @return an object whose get() returns the result of the call
+    def submit(self, func, args, meta=None):
+        if self.__pool == None:
+            return _Result(func(*args))
+        return self.__pool.apply_async(func, args)
+
+    def close(self):
+        if self.__pool != None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
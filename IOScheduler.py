@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+import os
+import errno
+import struct
+from multiprocessing.pool import ThreadPool
+
+import Stats
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl that maps the logical extents of a file to physical ones
+FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap followed by one struct fiemap_extent
+_FIEMAP_HEADER = "=QQIIII"
+_FIEMAP_EXTENT = "=QQQQQIIII"
+_FIEMAP_REQUEST = struct.pack(_FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)\
+                  + "\0" * struct.calcsize(_FIEMAP_EXTENT)
+
+# cleared once FIEMAP turns out to be unsupported
+_useFiemap = fcntl != None
+
+## This function returns the physical offset of the first extent of a file
+#  @return the offset, 0 for a file without extents, or None if it is unknown
+def _physicalOffset(path):
+    global _useFiemap
+
+    if not _useFiemap:
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        result = fcntl.ioctl(fd, FS_IOC_FIEMAP, _FIEMAP_REQUEST)
+    except IOError as e:
+        if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            _useFiemap = False
+        return None
+    finally:
+        os.close(fd)
+
+    if struct.unpack_from(_FIEMAP_HEADER, result)[3] == 0:
+        return 0
+    return struct.unpack_from(_FIEMAP_EXTENT, result, struct.calcsize(_FIEMAP_HEADER))[1]
+
+## This function returns the key files are read in the order of
+#  @param meta - FileMeta of the file from the directory scan, so the file
+#                is only stat'ed if it is not given
+#  @return (device, physical offset or inode number)
+def _diskKey(path, meta=None):
+    if meta == None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return (0, 0)
+        Stats.count("stats")
+        dev, ino = st.st_dev, st.st_ino
+    else:
+        dev, ino = meta.dev, meta.ino
+
+    offset = _physicalOffset(path)
+    return (dev, offset if offset != None else ino)
+
+class _Pending:
+    def __init__(self, scheduler):
+        self.__scheduler = scheduler
+        self.result = None
+
+    def get(self):
+        if self.result == None:
+            self.__scheduler.dispatch()
+        return self.result.get()
+
+## A drop in replacement of Hasher.HashPool for disks that seek slowly
+#  - Files submitted are held back until window files are pending, or until
+#    the result of one of them is needed. They are then read in the order of
+#    their physical offset on disk (FIEMAP), or of their inode number if the
+#    filesystem can not tell, which is close to the order of allocation.
+#  - Each device gets readersPerDevice reading threads of its own, so a
+#    device is never read by more threads than that, while several devices
+#    are read at the same time.
+#  - func is called with the path of the file as first argument.
+class IOScheduler:
+    ## Constructor
+    #  @param readersPerDevice - number of files read concurrently from each device
+    #  @param window - number of files sorted at a time
+    def __init__(self, readersPerDevice=1, window=256):
+        if readersPerDevice < 1:
+            raise Exception("number of readers per device must be at least 1")
+
+        self.jobs = readersPerDevice
+        self.window = window
+        self.__queue = []
+        self.__poolByDev = dict()
+
+    ## This function calls func with args once the file args[0] is scheduled
+    #  @param meta - FileMeta of the file, see _diskKey
+    #  @return an object whose get() returns the result of the call
+    def submit(self, func, args, meta=None):
+        pending = _Pending(self)
+        self.__queue.append((_diskKey(args[0], meta), func, args, pending))
+        if len(self.__queue) >= self.window:
+            self.dispatch()
+        return pending
+
+    ## This function hands the files held back to the readers of their device
+    def dispatch(self):
+        if not self.__queue:
+            return
+
+        self.__queue.sort(key=lambda item: item[0])
+        for key, func, args, pending in self.__queue:
+            pool = self.__poolByDev.get(key[0])
+            if pool == None:
+                pool = self.__poolByDev[key[0]] = ThreadPool(self.jobs)
+            pending.result = pool.apply_async(func, args)
+        Stats.count("ioBatches")
+        self.__queue = []
+
+    def close(self):
+        self.__queue = []
+        for pool in self.__poolByDev.itervalues():
+            pool.close()
+            pool.join()
+        self.__poolByDev = dict()
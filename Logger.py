@@ -3,23 +3,32 @@
 from enum import IntEnum
 import sys
 import datetime
-from time import gmtime, strftime, localtime
-from inspect import currentframe, getframeinfo
+from time import gmtime, strftime, localtime, time
 import ntpath
 import os
 import errno
 import pylru
+import threading
+import Queue
+import atexit
+import Stats
 
 # allowed maximum number of open log file handles
 MAX_OPEN_LOG_FILES = 20
 
 ## Logging infrastructure
-#  - Two modes:
+#  - Three modes:
 #    - File mode: This is the default mode.
 #    - Stdout mode: Logger provides a static function to globally redirect all logs to stdout.
 #          In this mode, each log message is prefixed with the log prefix.
+#    - Run log mode: Logger provides a static function to globally redirect all logs to a
+#          single file for the run. Log messages are prefixed as in Stdout mode.
 #  - 4 logging levels -- debug, info, warning and error -- with corresponding logging functions are
 #    available.
+#  - Log messages can be written by a background writer thread. Records are queued and
+#    written and flushed in batches.
+#  - Messages can be passed as a format string and arguments. The message is only formatted
+#    if its level is enabled.
 #  - Log message format:<br/>
 #    File mode:   <Time> - [<Log Level>] - [<File>:<Line>] <message><br/>
 #    Stdout mode: <Log prefix> -- <Time> - [<Log Level>] - [<File>:<Line>] <message><br/>
@@ -30,6 +39,11 @@ class Logger:
     # an lru cache of log file handles
     __logFhByPath = pylru.lrucache(MAX_OPEN_LOG_FILES, __lruEvictionCallback)
 
+    # open log files for which the 'latest' symlink has been updated, so it is
+    # not updated again when a file evicted from the cache is reopened. A
+    # file is dropped once its logger closes it.
+    __linkedPaths = set()
+
     @staticmethod
     def __getLogFh(path):
         if Logger.toStdOut:
@@ -38,9 +52,14 @@ class Logger:
         if path in Logger.__logFhByPath:
             return Logger.__logFhByPath[path]
         else:
-            logFh = open(path, "a", 0)
+            # buffering is only turned off when every message is written as it is logged
+            logFh = open(path, "a", 0) if Logger.__queue == None else open(path, "a")
             Logger.__logFhByPath[path] = logFh
+            if path in Logger.__linkedPaths:
+                return logFh
+
             # update symlink
+            Logger.__linkedPaths.add(path)
             logDir = os.path.dirname(os.path.abspath(path))
             latest = os.path.join(logDir, "latest")
             try:
@@ -57,6 +76,80 @@ class Logger:
         if not Logger.toStdOut and path in Logger.__logFhByPath:
             Logger.__logFhByPath[path].close()
             del Logger.__logFhByPath[path]
+        Logger.__linkedPaths.discard(path)
+
+    # queue of (path, text) records for the writer thread. text is None to close the file.
+    __queue = None
+    __writer = None
+
+    # maximum number of records written before the log files are flushed
+    MAX_BATCH = 1024
+
+    ## This function starts a thread that writes all log messages. Messages are
+    #  queued by the logging functions and written and flushed in batches.
+    @staticmethod
+    def startWriter():
+        if Logger.__writer != None:
+            return
+
+        Logger.__queue = Queue.Queue()
+        Logger.__writer = threading.Thread(target=Logger.__writeRecords)
+        Logger.__writer.daemon = True
+        Logger.__writer.start()
+        atexit.register(Logger.stopWriter)
+
+    ## This function writes out all the queued messages and stops the writer thread
+    @staticmethod
+    def stopWriter():
+        if Logger.__writer == None:
+            return
+
+        Logger.__queue.put(None)
+        Logger.__writer.join()
+        Logger.__writer = None
+        Logger.__queue = None
+
+    @staticmethod
+    def __writeRecords():
+        queue = Logger.__queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < Logger.MAX_BATCH:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = False
+            written = dict()
+            records = 0
+            start = time()
+            for record in batch:
+                if record == None:
+                    stop = True
+                    continue
+
+                path, text = record
+                if text == None:
+                    if path in written:
+                        del written[path]
+                    Logger.__closeLogFh(path)
+                    continue
+
+                fh = Logger.__getLogFh(path)
+                fh.write(text)
+                written[path] = fh
+                records += 1
+
+            for fh in written.itervalues():
+                fh.flush()
+            Stats.addTime("log write", time() - start)
+            Stats.count("logRecords", records)
+
+            if stop:
+                for path in Logger.__logFhByPath.keys():
+                    Logger.__closeLogFh(path)
+                return
 
     ## Logging levels
     class Level(IntEnum):
@@ -68,16 +161,14 @@ class Logger:
         ## A helper function to give a pretty version of logging level
         @staticmethod
         def toStr(level):
-            return {
-                Logger.Level.Debug : "DEBUG",
-                Logger.Level.Info : "INFO",
-                Logger.Level.Warn : "WARN",
-                Logger.Level.Error : "ERROR",
-                }.get(level)
+            return LEVEL_NAMES.get(level)
 
     ## Global override to direct all logs to stdout
     toStdOut = False
 
+    ## Global override to direct all logs to a single file for the run
+    runLogFile = None
+
     ## Loggig level
     logLevel = Level.Info
 
@@ -86,64 +177,114 @@ class Logger:
     def logToStdOut():
         Logger.toStdOut = True
 
+    ## A global override method, if called, will redirect all logs to a single file
+    #  @param path - path to the log file of the run
+    @staticmethod
+    def logToRunLog(path):
+        Logger.runLogFile = os.path.abspath(path)
+
     ## A function to change logging level
     @staticmethod
     def setLogLevel(level):
         Logger.logLevel = level
 
+    ## A function to check if messages at a logging level are logged
+    @staticmethod
+    def isEnabled(level):
+        return level >= Logger.logLevel
+
     ## A helper function to create a filename that is the timestamp
     @staticmethod
     def newLogFileName():
         return strftime("%Y%m%d_%H%M%S", gmtime())
 
     ## Constructor
-    #  @param logFilePath - fully qualified path to the log file
+    #  @param logFilePath - fully qualified path to the log file. Not used in
+    #                       run log mode.
     #  @param logPrefix - A prefix string that will be added to all log message
-    #                    in Stdout mode
+    #                    in Stdout and run log mode
     def __init__(self, logFilePath, logPrefix=None):
-        self.logFile = os.path.abspath(logFilePath)
+        if Logger.runLogFile != None:
+            self.logFile = Logger.runLogFile
+            self.ownsLogFile = False
+        else:
+            self.logFile = os.path.abspath(logFilePath)
+            self.ownsLogFile = True
         self.logPrefix = logPrefix
 
     ## Destructor
     def __del__(self):
-        Logger.__closeLogFh(self.logFile)
+        if not self.ownsLogFile:
+            return
+
+        if Logger.__queue != None:
+            Logger.__queue.put((self.logFile, None))
+        else:
+            Logger.__closeLogFh(self.logFile)
 
     ## Log debug message
-    #  @param msg - Log message
-    def debug(self, msg):
-        self.__logMsg(msg, Logger.Level.Debug)
+    #  @param msg - Log message, or format string for args
+    #  @param args - Arguments for the format string
+    def debug(self, msg, *args):
+        if Logger.Level.Debug >= Logger.logLevel:
+            self.__logMsg(msg, args, Logger.Level.Debug)
 
     ## Log informational message
-    #  @param msg - Log message
-    def info(self, msg):
-        self.__logMsg(msg, Logger.Level.Info)
+    #  @param msg - Log message, or format string for args
+    #  @param args - Arguments for the format string
+    def info(self, msg, *args):
+        if Logger.Level.Info >= Logger.logLevel:
+            self.__logMsg(msg, args, Logger.Level.Info)
 
     ## Log warning message
-    #  @param msg - Log message
-    def warn(self, msg):
-        self.__logMsg(msg, Logger.Level.Warn)
+    #  @param msg - Log message, or format string for args
+    #  @param args - Arguments for the format string
+    def warn(self, msg, *args):
+        if Logger.Level.Warn >= Logger.logLevel:
+            self.__logMsg(msg, args, Logger.Level.Warn)
 
     ## Log error message
-    #  @param msg - Log message
-    def error(self, msg):
-        self.__logMsg(msg, Logger.Level.Error)
+    #  @param msg - Log message, or format string for args
+    #  @param args - Arguments for the format string
+    def error(self, msg, *args):
+        if Logger.Level.Error >= Logger.logLevel:
+            self.__logMsg(msg, args, Logger.Level.Error)
 
-        return self.logFh
+    # the formatted time is only recomputed when the second changes
+    __timeSec = None
+    __timeStr = None
 
-    def __logMsg(self, msg, level):
-        if level < Logger.logLevel:
-            return
+    @staticmethod
+    def __now():
+        now = int(time())
+        if now != Logger.__timeSec:
+            Logger.__timeStr = strftime("%Y-%m-%d %H:%M:%S", localtime(now))
+            Logger.__timeSec = now
+        return Logger.__timeStr
 
-        # capture caller info
-        frameinfo = getframeinfo(currentframe().f_back.f_back)
+    def __logMsg(self, msg, args, level):
+        if args:
+            msg = msg.format(*args)
 
-        fh = Logger.__getLogFh(self.logFile)
-        if None != self.logPrefix and Logger.toStdOut:
-            fh.write(self.logPrefix + " -- ")
+        # capture caller info. the caller of the logging function is 2 frames up
+        frame = sys._getframe(2)
 
-        fh.write("{} - [{}] - [{}:{}] {}\n".
-                 format(strftime("%Y-%m-%d %H:%M:%S", localtime()),
-                        Logger.Level.toStr(level),
-                        ntpath.basename(frameinfo.filename),
-                        frameinfo.lineno, msg))
+        text = "{} - [{}] - [{}:{}] {}\n".format(Logger.__now(),
+                                                 LEVEL_NAMES[level],
+                                                 ntpath.basename(frame.f_code.co_filename),
+                                                 frame.f_lineno, msg)
+        if None != self.logPrefix and (Logger.toStdOut or Logger.runLogFile != None):
+            text = self.logPrefix + " -- " + text
+
+        if Logger.__queue != None:
+            Logger.__queue.put((self.logFile, text))
+        else:
+            Logger.__getLogFh(self.logFile).write(text)
+            Stats.count("logRecords")
 
+LEVEL_NAMES = {
+    Logger.Level.Debug : "DEBUG",
+    Logger.Level.Info : "INFO",
+    Logger.Level.Warn : "WARN",
+    Logger.Level.Error : "ERROR",
+    }
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+import os
+import sys
+import glob
+import hashlib
+import subprocess
+
+import Hasher
+import Stats
+from Logger import Logger
+from Directory import Directory, FPCache
+from FPIndex import FPIndex
+
+## One shard of a tree, for fingerprinting a tree in several processes or on
+#  several hosts that share its storage
+#  - The directories of the tree are split into count shards, either by
+#    their path ("hash") or by the top level directory they are in ("top").
+#    A shard holds the directories whose key hashes into its range, so the
+#    split only depends on the paths and needs no coordination.
+#  - A worker fingerprints the directories of its shard into a partial
+#    index, an FPIndex in the .dp/shards directory of the root. Fingerprints
+#    already recorded in the tree are reused for files that have not changed.
+#  - merge copies the partial indexes into the fingerprint store of the tree,
+#    fingerprints the tree once more to compute the stamps and Merkle digests
+#    of the directories, which depend on the whole subtree (nothing is hashed
+#    again unless it changed), and reports the internal dups.
+class Shard:
+    BY = ("hash", "top")
+
+    ## Constructor
+    #  @param root - root directory of the tree
+    #  @param index - number of the shard, from 0 to count - 1
+    #  @param count - number of shards
+    #  @param by - "hash" to split by directory path or "top" to split by top
+    #              level directory
+    def __init__(self, root, index, count, by="hash"):
+        if by not in Shard.BY:
+            raise Exception("shards are split by one of {}, not {}".format(", ".join(Shard.BY), by))
+        if count < 1 or index < 0 or index >= count:
+            raise Exception("invalid shard {}/{}".format(index, count))
+
+        self.root = os.path.abspath(root)
+        self.index = index
+        self.count = count
+        self.by = by
+        self.partialPath = os.path.join(Shard.shardsDir(self.root), "{}-{}-of-{}.db".format(by, index, count))
+
+    ## This function returns the directory the partial indexes of a tree are
+    #  written to
+    @staticmethod
+    def shardsDir(root):
+        return os.path.join(Directory.workDirOf(root), ".dp", "shards")
+
+    @staticmethod
+    def __removeIndex(path):
+        for f in [path, path + "-wal", path + "-shm"]:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    ## This function checks if a key is in the shard's range of hashes
+    def __owns(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16) * self.count >> 32 == self.index
+
+    ## This function yields the directories of the tree that are in the shard.
+    #  With "top", the subtrees of the other shards are not walked.
+    def __dirs(self):
+        for dir, subDirs, files in os.walk(self.root, followlinks=True):
+            subDirs[:] = sorted(d for d in subDirs if d != ".dp"\
+                                and os.path.join(dir, d) not in Directory.IgnoredDirs)
+            relDir = os.path.relpath(dir, self.root)
+            key = relDir if self.by == "hash" else relDir.split(os.sep)[0]
+            if self.__owns(key):
+                yield dir
+            elif relDir != "." and self.by == "top":
+                subDirs[:] = []
+
+    ## This function fingerprints the directories of the shard into its
+    #  partial index
+    #  @param jobs - number of files to hash concurrently
+    def fingerPrint(self, jobs=1):
+        tree = Directory(self.root)
+        tree.logger.info("fingerprinting shard {}/{} by {} of {}...",
+                         self.index, self.count, self.by, self.root)
+        if not os.path.isdir(os.path.dirname(self.partialPath)):
+            os.makedirs(os.path.dirname(self.partialPath))
+        Shard.__removeIndex(self.partialPath)
+
+        partial = FPIndex(self.partialPath, tree.dpWorkDir)
+        pool = Hasher.HashPool(jobs)
+        n = 0
+        try:
+            for path in self.__dirs():
+                # start from the fingerprints recorded in the tree, so files
+                # that did not change are not hashed
+                workDir = Directory.workDirOf(path)
+                recorded = FPCache(os.path.join(workDir, ".dp", "fpDB.txt"), tree.logger, tree.index)
+                partial.writeDir(workDir, recorded.fpByFile.values())
+                recorded = None
+
+                Directory(path, index=partial).refresh(pool)
+                n += 1
+        finally:
+            pool.close()
+            partial.close()
+
+        Stats.count("shardDirs", n)
+        tree.logger.info("fingerprinted {} directories into {}", n, self.partialPath)
+        return self.partialPath
+
+    ## This function merges the partial indexes of a tree into its fingerprint
+    #  store, then completes the fingerprints of the tree and reports its
+    #  internal dups
+    #  @param partialPaths - partial indexes to merge. By default, all those
+    #                        in the .dp/shards directory of the tree.
+    #  @param useIndex, jobs - see Directory and Directory.fingerPrint
+    @staticmethod
+    def merge(root, partialPaths=None, useIndex=None, jobs=1):
+        if partialPaths == None:
+            partialPaths = sorted(glob.glob(os.path.join(Shard.shardsDir(root), "*.db")))
+        if not partialPaths:
+            raise Exception("no partial indexes to merge for " + root)
+
+        tree = Directory(root, useIndex=useIndex)
+        if tree.index != None:
+            store = tree.index
+        else:
+            # the fingerprint databases of the directories are written from
+            # an index holding all the partial indexes
+            mergedPath = os.path.join(Shard.shardsDir(root), "merged.index")
+            Shard.__removeIndex(mergedPath)
+            store = FPIndex(mergedPath, tree.dpWorkDir)
+
+        merged = set()
+        for path in partialPaths:
+            tree.logger.info("merging {}...", path)
+            merged.update(store.mergeFrom(path))
+
+        if tree.index == None:
+            for d in Directory(root, index=store).walkPruned(lambda d: False):
+                if store.relPath(d.dpWorkDir) in merged:
+                    d.fpCache.exportDB()
+            store.close()
+            Shard.__removeIndex(mergedPath)
+        tree.logger.info("merged {} directories from {} partial indexes", len(merged), len(partialPaths))
+
+        tree = Directory(root, index=tree.index)
+        tree.fingerPrint(jobs=jobs)
+        tree.checkForInternalDups()
+
+        for path in partialPaths:
+            Shard.__removeIndex(path)
+
+    ## This function fingerprints a tree with a worker process per shard and
+    #  merges their partial indexes
+    #  @param workerArgs - options of main.py passed on to each worker
+    #  @param useIndex, jobs - see merge. Each worker hashes jobs files at a time.
+    #  With a run log, each worker logs to its own <run log>.<shard>.
+    @staticmethod
+    def run(root, count, by="hash", workerArgs=[], useIndex=None, jobs=1):
+        mainPy = os.path.join(os.path.dirname(os.path.realpath(__file__)), "main.py")
+        def runLogArgs(i):
+            if Logger.runLogFile == None:
+                return []
+            return ["--run-log={}.{}".format(Logger.runLogFile, i)]
+
+        workers = [subprocess.Popen([sys.executable, mainPy, "--mode=fingerprint-shard",
+                                     "--shard={}/{}".format(i, count), "--shard-by=" + by,
+                                     "--jobs={}".format(jobs)] + workerArgs + runLogArgs(i) + [root])
+                   for i in range(count)]
+
+        failed = [i for i, worker in enumerate(workers) if worker.wait() != 0]
+        if failed:
+            raise Exception("shards {} of {} failed".format(", ".join(map(str, failed)), root))
+
+        Shard.merge(root, [Shard(root, i, count, by).partialPath for i in range(count)],
+                    useIndex, jobs)
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+import os
+import mmap
+import struct
+import hashlib
+
+import Stats
+from Directory import Directory, Fingerprint, sameMtime
+from FPIndex import FPIndex
+
+## A snapshot of the fingerprints of a tree in a single file
+#  - Meant for trees that are read only or not always mounted, e.g. DVDs and
+#    old volumes: fingerprinting such a tree with a snapshot leaves one file
+#    behind instead of a fingerprint database per directory.
+#  - The file is a header, fixed width records sorted by digest and size, and
+#    a table of the strings the records point to:
+#      header:  magic, version, record count, offset of the string table,
+#               offset of the root path in the string table
+#      record:  key, size, mtime (ns), offsets of the directory (relative to
+#               the root), file name, digest and partial digest
+#      strings: length (4 bytes) and bytes of each distinct string
+#    The key is the md5 of the digest string, so digests of any algorithm
+#    sort and compare as 16 bytes.
+#  - The file is memory mapped and digests are looked up by binary search, so
+#    a snapshot of any size is used as a reference without being read.
+class Snapshot:
+    MAGIC = "DPSNAP\0\0"
+    VERSION = 1
+    HEADER = struct.Struct("=8sIQQQ")
+    RECORD = struct.Struct("=16sQqQQQQ")
+    LENGTH = struct.Struct("=I")
+
+    ## Constructor
+    #  @param path - path to the snapshot file
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.__fh = open(self.path, "rb")
+        self.__map = mmap.mmap(self.__fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, self.__strings, rootOffset = Snapshot.HEADER.unpack_from(self.__map, 0)
+        if magic != Snapshot.MAGIC:
+            raise Exception("{} is not a fingerprint snapshot".format(self.path))
+        if version > Snapshot.VERSION:
+            raise Exception("{} has snapshot version {}, newer than supported version {}"\
+                            .format(self.path, version, Snapshot.VERSION))
+        self.root = self.__string(rootOffset)
+
+    def close(self):
+        if self.__map != None:
+            self.__map.close()
+            self.__fh.close()
+            self.__map = None
+
+    @staticmethod
+    def __key(md5):
+        return hashlib.md5(md5).digest()
+
+    def __string(self, offset):
+        start = self.__strings + offset
+        n = Snapshot.LENGTH.unpack_from(self.__map, start)[0]
+        start += Snapshot.LENGTH.size
+        return self.__map[start:start + n]
+
+    def __record(self, i):
+        return Snapshot.RECORD.unpack_from(self.__map, Snapshot.HEADER.size + i * Snapshot.RECORD.size)
+
+    ## This function returns the fingerprint of a record
+    #  @return (directory relative to the root, Fingerprint)
+    def __toFingerprint(self, record):
+        key, size, mtime, dir, file, md5, partial = record
+        relDir = self.__string(dir)
+        return relDir, Fingerprint(self.__string(file), os.path.normpath(os.path.join(self.root, relDir)),
+                                   self.__string(md5), mtime, size, self.__string(partial))
+
+    ## This function yields the fingerprints in the snapshot
+    #  @return (directory relative to the root, Fingerprint) for each file
+    def records(self):
+        for i in xrange(self.count):
+            yield self.__toFingerprint(self.__record(i))
+
+    ## This function finds the files with the given digest and size
+    #  @return list of Fingerprint
+    def lookup(self, md5, size):
+        if not md5:
+            return []
+
+        # first record not before (key, size)
+        target = (Snapshot.__key(md5), size)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__record(mid)[:2] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        fps = []
+        while lo < self.count:
+            record = self.__record(lo)
+            if record[:2] != target:
+                break
+            relDir, fp = self.__toFingerprint(record)
+            if fp.md5 == md5:
+                fps.append(fp)
+            lo += 1
+        return fps
+
+    ## This function finds a copy of a file in the snapshot, see Directory.checkFile
+    #  @return Fingerprint of the copy or None
+    def checkFile(self, fp):
+        Stats.count("lookups")
+        with Stats.Timer("lookup"):
+            fps = self.lookup(fp.md5, fp.size)
+        if not fps:
+            return None
+
+        Stats.count("lookupHits")
+        return fps[0]
+
+    ## This function writes a snapshot file. The file is written next to path
+    #  and renamed over it once it is complete.
+    #  @param root - root directory of the tree
+    #  @param entries - iterable of (directory relative to the root, Fingerprint)
+    @staticmethod
+    def write(path, root, entries):
+        offsets = dict()
+        strings = []
+        stringsSize = [0]
+
+        def intern(s):
+            offset = offsets.get(s)
+            if offset == None:
+                offset = offsets[s] = stringsSize[0]
+                strings.append(s)
+                stringsSize[0] += Snapshot.LENGTH.size + len(s)
+            return offset
+
+        rootOffset = intern(root)
+        records = []
+        for relDir, fp in entries:
+            mtime = fp.mtime
+            if isinstance(mtime, float):
+                # seconds, see sameMtime. rounded like the modify times of
+                # Python 2 stats, see mtimeNs.
+                mtime = long(round(mtime * 1000000)) * 1000
+            records.append((Snapshot.__key(fp.md5), fp.size, mtime, intern(relDir),
+                            intern(fp.file), intern(fp.md5), intern(fp.partial)))
+        records.sort()
+
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as fh:
+            fh.write(Snapshot.HEADER.pack(Snapshot.MAGIC, Snapshot.VERSION, len(records),
+                                          Snapshot.HEADER.size + len(records) * Snapshot.RECORD.size,
+                                          rootOffset))
+            for record in records:
+                fh.write(Snapshot.RECORD.pack(*record))
+            for s in strings:
+                fh.write(Snapshot.LENGTH.pack(len(s)))
+                fh.write(s)
+            fh.flush()
+            os.fsync(fh.fileno())
+            Stats.count("fsyncs")
+        os.rename(tmpPath, path)
+        return len(records)
+
+    ## This function writes the fingerprints of a tree to a snapshot file
+    #  @param dir - Directory of the root of the tree
+    #  @return number of fingerprints written
+    @staticmethod
+    def export(dir, path):
+        dir.logger.info("exporting fingerprints of {} to {}...", dir.path, path)
+        n = Snapshot.write(path, dir.path,
+                           ((os.path.relpath(d.path, dir.path), fp)
+                            for d in dir.walkPruned(lambda d: False)
+                            for fp in d.fpCache.fpByFile.values()))
+        dir.logger.info("exported {} fingerprints", n)
+        return n
+
+    ## This function groups the fingerprints in the snapshot by directory
+    #  @return dict of directory relative to the root -> list of Fingerprint
+    def __byDir(self):
+        fpsByDir = dict()
+        for relDir, fp in self.records():
+            fpsByDir.setdefault(relDir, []).append(fp)
+        return fpsByDir
+
+    ## This function records the fingerprints in the snapshot in the fingerprint
+    #  databases (or index) of a tree. Only the fingerprints of files whose
+    #  size and modify time are the same as in the snapshot are recorded.
+    #  @param dir - Directory of the root of the tree. It need not be the root
+    #               the snapshot was made from.
+    #  @return number of fingerprints recorded
+    def importTo(self, dir):
+        dir.logger.info("importing fingerprints from {}...", self.path)
+        fpsByDir = self.__byDir()
+        n = 0
+        for d in dir.walkPruned(lambda d: False):
+            fps = fpsByDir.get(os.path.relpath(d.path, dir.path), [])
+            for fp in fps:
+                info = d.fstatByName.get(fp.file)
+                if info == None:
+                    continue
+                meta = info.stat()
+                if meta.size == fp.size and sameMtime(fp.mtime, meta.mtimeNs):
+                    d.fpCache.addFingerprint(fp.file, fp.md5, fp.mtime, fp.size, fp.partial)
+                    n += 1
+            d.fpCache.flushCache()
+
+        dir.logger.info("imported {} fingerprints", n)
+        return n
+
+    ## This function fingerprints a tree into a snapshot file. The fingerprints
+    #  are kept in a temporary FPIndex next to the snapshot while the tree is
+    #  fingerprinted, starting from those in the snapshot if it exists, so
+    #  files that have not changed since the snapshot are not hashed again.
+    #  @param dryRun, sizePrefilter, jobs, skipUnchanged, upgradeDigests,
+    #         ioOrder - see Directory.fingerPrint. The snapshot holds no
+    #         directory stamps, so skipUnchanged skips nothing.
+    #  @return number of fingerprints in the snapshot
+    @staticmethod
+    def fingerPrint(path, snapshotPath, dryRun=False, sizePrefilter=False, jobs=1,\
+                    skipUnchanged=False, upgradeDigests=False, ioOrder=False):
+        path = os.path.abspath(path)
+        snapshotPath = os.path.abspath(snapshotPath)
+        workDir = Directory.workDirOf(path)
+
+        indexFile = snapshotPath + ".index"
+        for f in [indexFile, indexFile + "-wal", indexFile + "-shm"]:
+            if os.path.isfile(f):
+                os.remove(f)
+
+        index = FPIndex(indexFile, workDir)
+        try:
+            if os.path.isfile(snapshotPath):
+                snapshot = Snapshot(snapshotPath)
+                for relDir, fps in snapshot.__byDir().iteritems():
+                    index.writeDir(os.path.join(workDir, relDir), fps)
+                snapshot.close()
+
+            # lookups in a snapshot need no filter
+            Directory(path, index=index).fingerPrint(dryRun, sizePrefilter, jobs, skipUnchanged,\
+                                                     upgradeDigests, ioOrder, False)
+            if dryRun:
+                return 0
+            return Snapshot.export(Directory(path, index=index), snapshotPath)
+        finally:
+            index.close()
+            for f in [indexFile, indexFile + "-wal", indexFile + "-shm"]:
+                if os.path.isfile(f):
+                    os.remove(f)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import sys
+import time
+import json
+import threading
+
+## Run statistics
+#  - Counters (files scanned, bytes hashed, lookups, ...) and timers (seconds
+#    spent scanning, hashing, ...) for the whole run, kept in module globals.
+#  - Hashing and copying threads update them too, so updates take a lock.
+#    Timers of work done on a pool add up the time of every thread.
+#  - progress() prints a one line summary to stderr at most once per
+#    progressInterval seconds. Long loops call it after each step.
+#  - report() prints all the statistics as text or as JSON.
+
+counters = dict()
+timers = dict()
+startTime = time.time()
+
+# seconds between progress lines. None turns progress off.
+progressInterval = None
+
+_lock = threading.Lock()
+_lastProgress = startTime
+
+## This function adds n to a counter
+def count(name, n=1):
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+## This function adds seconds to a timer
+def addTime(name, seconds):
+    with _lock:
+        timers[name] = timers.get(name, 0.0) + seconds
+
+## Context manager that adds the time spent in its block to a timer
+class Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        addTime(self.name, time.time() - self.start)
+        return False
+
+def _mbPerSec(n, seconds):
+    return n / (1024.0 * 1024.0) / seconds if seconds > 0 else 0.0
+
+## This function computes the statistics derived from the counters
+def derived():
+    wall = time.time() - startTime
+    hashed = counters.get("filesHashed", 0)
+    unchanged = counters.get("filesUnchanged", 0)
+    result = {"wallSeconds" : round(wall, 3),
+              "hashMBPerSecWall" : round(_mbPerSec(counters.get("bytesHashed", 0), wall), 1),
+              "hashMBPerSecThread" : round(_mbPerSec(counters.get("bytesHashed", 0),\
+                                                     timers.get("hash", 0.0)), 1)}
+    if hashed + unchanged > 0:
+        result["cacheHitRatio"] = round(float(unchanged) / (hashed + unchanged), 4)
+    return result
+
+## This function prints a progress line if progressInterval seconds have
+#  passed since the last one
+def progress():
+    global _lastProgress
+
+    if progressInterval == None:
+        return
+    now = time.time()
+    if now - _lastProgress < progressInterval:
+        return
+    _lastProgress = now
+
+    sys.stderr.write("[{:.0f}s] scanned {} files in {} dirs, unchanged {}, hashed {} files"
+                     " ({:.1f} MB, {:.1f} MB/s), lookups {}\n"\
+                     .format(now - startTime,
+                             counters.get("filesScanned", 0), counters.get("dirsScanned", 0),
+                             counters.get("filesUnchanged", 0), counters.get("filesHashed", 0),
+                             counters.get("bytesHashed", 0) / (1024.0 * 1024.0),
+                             _mbPerSec(counters.get("bytesHashed", 0), now - startTime),
+                             counters.get("lookups", 0)))
+
+## This function prints all the statistics
+#  @param format - "text" or "json"
+def report(format="text", out=sys.stdout):
+    stats = derived()
+    if format == "json":
+        out.write(json.dumps({"counters" : counters,
+                              "timers" : dict((k, round(v, 3)) for k, v in timers.iteritems()),
+                              "derived" : stats}, sort_keys=True) + "\n")
+        return
+
+    out.write("run statistics:\n")
+    out.write("  {:<24} {:.2f}\n".format("wall seconds", stats["wallSeconds"]))
+    if "cacheHitRatio" in stats:
+        out.write("  {:<24} {:.1%}\n".format("cache hit ratio", stats["cacheHitRatio"]))
+    if counters.get("bytesHashed", 0):
+        out.write("  {:<24} {:.1f} (wall), {:.1f} (per thread)\n"\
+                  .format("hashing MB/s", stats["hashMBPerSecWall"], stats["hashMBPerSecThread"]))
+    for name in sorted(counters.keys()):
+        out.write("  {:<24} {}\n".format(name, counters[name]))
+    for name in sorted(timers.keys()):
+        out.write("  {:<24} {:.3f}\n".format(name + " seconds", timers[name]))
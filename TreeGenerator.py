@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+import os
+import random
+
+## Generator of synthetic directory trees for benchmarks
+#  - Files are spread over a tree of the given depth and fan out. Their sizes
+#    are drawn from a log-uniform distribution, so most files are small and a
+#    few are large, as in a typical archive.
+#  - A fraction of the files, set by the dup ratio, are copies of files that
+#    were generated before, in the same tree or in other trees made by the
+#    same generator.
+#  - Trees only depend on the seed and the parameters, so runs on different
+#    commits hash the same data.
+#  - Each file starts and ends with its content id, so files of the same size
+#    with different content also differ in their partial digests. The rest of
+#    the file is filled from a shared block of random data.
+class TreeGenerator:
+    BLOCK_SIZE = 1024 * 1024
+
+    ## Constructor
+    #  @param seed - seed of the random number generator
+    #  @param minSize, maxSize - bounds of the file sizes in bytes
+    #  @param depth - number of directory levels below the root
+    #  @param fanout - number of sub directories of each directory
+    def __init__(self, seed=0, minSize=1024, maxSize=1024 * 1024, depth=3, fanout=4):
+        if minSize < 1 or maxSize < minSize:
+            raise Exception("invalid file size range {}:{}".format(minSize, maxSize))
+
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.depth = depth
+        self.fanout = fanout
+
+        self.__random = random.Random(seed)
+        self.__block = bytearray(self.__random.getrandbits(8) for i in xrange(TreeGenerator.BLOCK_SIZE))
+        self.__nextId = 0
+        # (content id, size) of every file generated so far
+        self.contents = []
+
+    def __drawSize(self):
+        if self.minSize == self.maxSize:
+            return self.minSize
+        return int(round(self.minSize * (float(self.maxSize) / self.minSize) ** self.__random.random()))
+
+    def __dirPaths(self, root):
+        paths = [root]
+        level = [root]
+        for d in range(self.depth):
+            level = [os.path.join(p, "d{}".format(i)) for p in level for i in range(self.fanout)]
+            paths.extend(level)
+        return paths
+
+    def __writeFile(self, path, contentId, size):
+        tag = "<{}>".format(contentId)
+        with open(path, "wb") as fh:
+            if size <= 2 * len(tag):
+                fh.write((tag * (size // len(tag) + 1))[:size])
+                return
+
+            fh.write(tag)
+            left = size - 2 * len(tag)
+            while left > 0:
+                n = min(left, len(self.__block))
+                fh.write(self.__block[:n])
+                left -= n
+            fh.write(tag)
+
+    ## This function generates a tree
+    #  @param path - root of the tree. created if it does not exist
+    #  @param files - number of files
+    #  @param dupRatio - fraction of the files that are copies of files
+    #                    generated before
+    #  @return total number of bytes written
+    def generate(self, path, files, dupRatio=0.0):
+        dirs = self.__dirPaths(path)
+        for d in dirs:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+        total = 0
+        for i in xrange(files):
+            if self.contents and self.__random.random() < dupRatio:
+                contentId, size = self.__random.choice(self.contents)
+            else:
+                contentId, size = self.__nextId, self.__drawSize()
+                self.__nextId += 1
+                self.contents.append((contentId, size))
+
+            d = self.__random.choice(dirs)
+            self.__writeFile(os.path.join(d, "f{}.bin".format(i)), contentId, size)
+            total += size
+
+        return total
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+import os
+import errno
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+
+import Hasher
+import Stats
+from Directory import Directory
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO\
+             | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+# size of struct inotify_event without the name
+EVENT_HEADER = struct.calcsize("iIII")
+
+# seconds between scans when inotify can not be used
+DEFAULT_POLL_SECONDS = 60
+
+_libc = None
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+except OSError:
+    pass
+
+def _libcCall(name, *args):
+    func = getattr(_libc, name, None) if _libc != None else None
+    if func == None:
+        raise OSError(errno.ENOSYS, name + " is not available")
+    ret = func(*args)
+    if ret < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return ret
+
+## Keeps the fingerprints of a tree up to date as it changes
+#  - The tree is fingerprinted once, then the directories reported changed by
+#    inotify are fingerprinted again, see Directory.refresh. Their ancestors
+#    are stamped again too, so stamps, rollups and Merkle digests stay valid.
+#  - Events are read on a thread of their own, which only notes the changed
+#    directories. A directory is fingerprinted from the main thread, on a
+#    HashPool, once no event came for it for debounce seconds, so a file
+#    being written is hashed once, after the last write.
+#  - Without inotify, or with a poll interval, the tree is fingerprinted
+#    every poll interval seconds instead, skipping unchanged directories.
+#    Files rewritten in place are missed then.
+class Watcher:
+    ## Constructor
+    #  @param path - root of the tree
+    #  @param jobs - number of files to hash concurrently
+    #  @param debounce - seconds without events before a directory is
+    #                    fingerprinted
+    #  @param pollInterval - if set, poll every pollInterval seconds instead
+    #                        of using inotify
+    #  @param useIndex - see Directory
+    def __init__(self, path, jobs=1, debounce=2.0, pollInterval=None, useIndex=None):
+        self.path = os.path.abspath(path)
+        self.jobs = jobs
+        self.debounce = debounce
+        self.pollInterval = pollInterval
+
+        self.__root = Directory(self.path, useIndex=useIndex)
+        self.logger = self.__root.logger
+
+        # directory path -> [time of its last event, whether its subtree changed]
+        self.__dirty = dict()
+        self.__lock = threading.Lock()
+
+        self.__fd = None
+        self.__pathByWd = dict()
+        self.__wdByPath = dict()
+
+    ## This function fingerprints the tree and then keeps it up to date until
+    #  the process is interrupted
+    def run(self):
+        self.__root.fingerPrint(jobs=self.jobs)
+
+        if self.pollInterval == None:
+            try:
+                self.__fd = _libcCall("inotify_init1", IN_CLOEXEC)
+                self.__watchTree(self.path)
+            except OSError as e:
+                self.logger.warn("can not watch {} ({}), polling every {} seconds...",
+                                 self.path, e, DEFAULT_POLL_SECONDS)
+                if self.__fd != None:
+                    os.close(self.__fd)
+                    self.__fd = None
+                self.pollInterval = DEFAULT_POLL_SECONDS
+
+        if self.pollInterval != None:
+            self.__poll()
+        else:
+            self.__watch()
+
+    def __poll(self):
+        while True:
+            time.sleep(self.pollInterval)
+            Directory(self.path, index=self.__root.index).fingerPrint(jobs=self.jobs,
+                                                                      skipUnchanged=True)
+
+    def __watch(self):
+        self.logger.info("watching {} directories under {}...", len(self.__pathByWd), self.path)
+        reader = threading.Thread(target=self.__readEvents)
+        reader.daemon = True
+        reader.start()
+
+        pool = Hasher.HashPool(self.jobs)
+        try:
+            while reader.is_alive():
+                dirs = self.__takeQuietDirs()
+                if dirs:
+                    self.__refresh(dirs, pool)
+                else:
+                    time.sleep(self.debounce / 4.0)
+        finally:
+            pool.close()
+
+        raise Exception("stopped reading inotify events")
+
+    ## This function removes the directories that had no event for debounce
+    #  seconds from the dirty ones
+    #  @return dict of directory path -> whether its subtree changed
+    def __takeQuietDirs(self):
+        now = time.time()
+        dirs = dict()
+        with self.__lock:
+            for path, (last, recursive) in self.__dirty.items():
+                if now - last >= self.debounce:
+                    dirs[path] = recursive
+                    del self.__dirty[path]
+        return dirs
+
+    def __markDirty(self, path, recursive):
+        with self.__lock:
+            entry = self.__dirty.setdefault(path, [0, False])
+            entry[0] = time.time()
+            entry[1] = entry[1] or recursive
+
+    ## This function fingerprints the changed directories and their ancestors
+    #  again, deepest first, so a directory is stamped after its sub directories
+    def __refresh(self, dirs, pool):
+        todo = dict(dirs)
+        for path in dirs.iterkeys():
+            while path != self.path and path != os.path.dirname(path):
+                path = os.path.dirname(path)
+                todo.setdefault(path, False)
+
+        for path in sorted(todo.iterkeys(), key=lambda p: p.count(os.sep), reverse=True):
+            if not os.path.isdir(path):
+                # a removed directory takes its fingerprint database along,
+                # but not its fingerprints in the index
+                if self.__root.index != None:
+                    self.__root.index.removeTree(path)
+                continue
+
+            Stats.count("dirsRefreshed")
+            Directory(path, index=self.__root.index).refresh(pool, todo[path])
+        Stats.progress()
+
+    def __watchTree(self, path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d != ".dp"\
+                       and os.path.join(root, d) not in Directory.IgnoredDirs]
+            try:
+                wd = _libcCall("inotify_add_watch", self.__fd, root, ctypes.c_uint32(WATCH_MASK))
+            except OSError as e:
+                # the directory was removed since it was listed
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            self.__pathByWd[wd] = root
+            self.__wdByPath[root] = wd
+
+    def __unwatchTree(self, path):
+        prefix = path + os.sep
+        for p in [p for p in self.__wdByPath.iterkeys() if p == path or p.startswith(prefix)]:
+            wd = self.__wdByPath.pop(p)
+            del self.__pathByWd[wd]
+            try:
+                _libcCall("inotify_rm_watch", self.__fd, wd)
+            except OSError:
+                # the watch is already gone with its directory
+                pass
+
+    def __readEvents(self):
+        while True:
+            buf = os.read(self.__fd, 64 * 1024)
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = struct.unpack_from("iIII", buf, offset)
+                name = buf[offset + EVENT_HEADER:offset + EVENT_HEADER + length].rstrip("\0")
+                offset += EVENT_HEADER + length
+                self.__onEvent(wd, mask, name)
+
+    def __onEvent(self, wd, mask, name):
+        Stats.count("watchEvents")
+        if mask & IN_Q_OVERFLOW:
+            self.logger.warn("inotify events were lost, fingerprinting {} again...", self.path)
+            self.__markDirty(self.path, True)
+            return
+
+        dir = self.__pathByWd.get(wd)
+        if dir == None:
+            return
+        if mask & IN_IGNORED:
+            # the directory was removed. its parent gets an event too.
+            if self.__wdByPath.get(dir) == wd:
+                del self.__wdByPath[dir]
+            del self.__pathByWd[wd]
+            return
+        if not name or name == ".dp":
+            return
+
+        path = os.path.join(dir, name)
+        if mask & IN_ISDIR:
+            if path in Directory.IgnoredDirs:
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.__watchTree(path)
+                except OSError as e:
+                    self.logger.warn("can not watch {} ({}), its changes will be missed", path, e)
+                self.__markDirty(path, True)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.__unwatchTree(path)
+                self.__markDirty(path, False)
+        elif name in Directory.IgnoredFiles:
+            return
+
+        self.__markDirty(dir, False)
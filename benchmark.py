@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+## Fingerprinting throughput benchmark
+#  Fingerprints a directory tree from scratch once for each number of jobs and
+#  reports how hashing throughput scales with the size of the worker pool.
+#  Without a directory, a temporary tree of random files is generated.
+
+import sys, getopt
+import os
+import shutil
+import tempfile
+import time
+
+from Directory import Directory
+from Logger import Logger
+
+def printUsage():
+    print "benchmark.py [--files=N --size=BYTES --jobs=1,2,4,8 --drop-caches] [<dir>]"
+
+## This function creates a flat tree of files filled with random data
+def generateTree(path, files, size):
+    for i in range(files):
+        with open(os.path.join(path, "file{}.bin".format(i)), "wb") as fh:
+            fh.write(os.urandom(size))
+
+## This function removes the fingerprint databases so the next run hashes
+#  every file again
+def removeWorkDirs(path):
+    for root, dirs, files in os.walk(path):
+        if ".dp" in dirs:
+            shutil.rmtree(os.path.join(root, ".dp"))
+            dirs.remove(".dp")
+
+def treeSize(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        if ".dp" in dirs:
+            dirs.remove(".dp")
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+## This function empties the page cache so that files are read from the disk.
+#  Needs root.
+def dropCaches():
+    os.system("sync")
+    with open("/proc/sys/vm/drop_caches", "w") as fh:
+        fh.write("3\n")
+
+def main(argv):
+    files = 64
+    size = 16 * 1024 * 1024
+    jobsList = [1, 2, 4, 8]
+    drop = False
+    try:
+        opts, args = getopt.getopt(argv, "", ["files=", "size=", "jobs=", "drop-caches"])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == "--files":
+            files = int(arg)
+        elif opt == "--size":
+            size = int(arg)
+        elif opt == "--jobs":
+            jobsList = [int(j) for j in arg.split(",")]
+        elif opt == "--drop-caches":
+            drop = True
+
+    Logger.setLogLevel(Logger.Level.Warn)
+
+    tmpDir = None
+    if args:
+        path = os.path.abspath(args[0])
+    else:
+        tmpDir = tempfile.mkdtemp(prefix="dp_bench_")
+        path = tmpDir
+        print "generating {} files of {} bytes in {}...".format(files, size, path)
+        generateTree(path, files, size)
+
+    try:
+        mb = treeSize(path) / (1024.0 * 1024.0)
+        print "{:>6} {:>10} {:>10}".format("jobs", "seconds", "MB/s")
+        for jobs in jobsList:
+            removeWorkDirs(path)
+            if drop:
+                dropCaches()
+
+            start = time.time()
+            Directory(path).fingerPrint(jobs=jobs)
+            elapsed = time.time() - start
+            print "{:>6} {:>10.2f} {:>10.1f}".format(jobs, elapsed, mb / elapsed)
+    finally:
+        if tmpDir != None:
+            shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+## Benchmark suite
+#  Generates a candidate and a reference tree with TreeGenerator and runs each
+#  main.py mode on them twice: cold, with no fingerprint databases (fingerprint
+#  mode) and the page cache dropped if possible, and warm, right after. For
+#  each run the wall time, the bytes read, the read and write syscalls and the
+#  peak RSS of main.py are appended as JSON lines to a results file, along with
+#  the commit being measured. --compare prints the results of several commits
+#  side by side.
+
+import sys, getopt
+import os
+import shutil
+import tempfile
+import time
+import json
+import subprocess
+import platform
+
+from TreeGenerator import TreeGenerator
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+def printUsage():
+    print "benchsuite.py [--files=N --sizes=MIN:MAX --depth=N --fanout=N --dup-ratio=R --seed=N"
+    print "               --jobs=N --modes=m1,m2 --out=<file> --keep=<dir>]"
+    print "benchsuite.py --compare <results file>"
+
+def removeWorkDirs(path):
+    for root, dirs, files in os.walk(path):
+        if ".dp" in dirs:
+            shutil.rmtree(os.path.join(root, ".dp"))
+            dirs.remove(".dp")
+
+## This function empties the page cache
+#  @return False if the cache could not be dropped, e.g. when not run as root
+def dropCaches():
+    try:
+        os.system("sync")
+        with open("/proc/sys/vm/drop_caches", "w") as fh:
+            fh.write("3\n")
+        return True
+    except IOError:
+        return False
+
+## This function returns the I/O counters of this process. Counters of waited
+#  for children are added to them by the kernel.
+def readIoCounters():
+    counters = dict()
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except IOError:
+        pass
+    return counters
+
+def gitCommit():
+    try:
+        cwd = os.path.dirname(MAIN)
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=cwd).strip()
+        if subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=cwd) != 0:
+            commit += "-dirty"
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+## This function runs main.py and measures it
+#  @return dict of measurements
+def runMain(args):
+    before = readIoCounters()
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen([sys.executable, MAIN] + args, stdout=devnull, stderr=devnull)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    after = readIoCounters()
+
+    result = {"seconds" : round(elapsed, 3),
+              "status" : os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+              "maxRssKb" : rusage.ru_maxrss,
+              "userSeconds" : round(rusage.ru_utime, 3),
+              "sysSeconds" : round(rusage.ru_stime, 3)}
+    for name, key in [("rchar", "bytesRead"), ("read_bytes", "diskBytesRead"),\
+                      ("syscr", "readSyscalls"), ("syscw", "writeSyscalls")]:
+        if name in before and name in after:
+            result[key] = after[name] - before[name]
+    return result
+
+## Modes and how to run them. Each entry is (name, function(cand, ref, dst) ->
+#  main.py arguments, whether the cold run starts without fingerprints)
+def modeTable(jobs):
+    return [("fingerprint", lambda c, r, d: ["--mode=fingerprint", "--no-log", "--jobs={}".format(jobs), c], True),
+            ("check-int-dups", lambda c, r, d: ["--mode=check-int-dups", "--no-log", c], False),
+            ("check-dup-dirs", lambda c, r, d: ["--mode=check-dup-dirs", "--no-log", c], False),
+            ("remove-dups", lambda c, r, d: ["--mode=remove-dups", "-n", "--no-log", c, r], False),
+            ("copy-uniq-files", lambda c, r, d: ["--mode=copy-uniq-files", "--no-log",\
+                                                 "--jobs={}".format(jobs), c, r, d], False)]
+
+def runSuite(params, modes, jobs, outPath, keep):
+    tmpDir = keep if keep != None else tempfile.mkdtemp(prefix="dp_suite_")
+    cand = os.path.join(tmpDir, "cand")
+    ref = os.path.join(tmpDir, "ref")
+    dst = os.path.join(tmpDir, "dst")
+
+    try:
+        if not os.path.isdir(cand):
+            print "generating trees in {}...".format(tmpDir)
+            gen = TreeGenerator(params["seed"], params["minSize"], params["maxSize"],\
+                                params["depth"], params["fanout"])
+            params["refBytes"] = gen.generate(ref, params["files"], params["dupRatio"])
+            params["candBytes"] = gen.generate(cand, params["files"], params["dupRatio"])
+
+        # every mode but fingerprint needs fingerprinted trees
+        runMain(["--mode=fingerprint", "--no-log", "--jobs={}".format(jobs), ref])
+        runMain(["--mode=fingerprint", "--no-log", "--jobs={}".format(jobs), cand])
+
+        common = {"commit" : gitCommit(),
+                  "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "python" : platform.python_version(),
+                  "jobs" : jobs,
+                  "tree" : params}
+
+        print "{:<16} {:<5} {:>9} {:>12} {:>10} {:>10}".format("mode", "run", "seconds", "bytes read", "syscalls", "RSS KiB")
+        with open(outPath, "a") as out:
+            for name, makeArgs, fromScratch in modeTable(jobs):
+                if modes and name not in modes:
+                    continue
+
+                for phase in ["cold", "warm"]:
+                    if os.path.isdir(dst):
+                        shutil.rmtree(dst)
+                    os.makedirs(dst)
+
+                    dropped = False
+                    if phase == "cold":
+                        if fromScratch:
+                            removeWorkDirs(cand)
+                        dropped = dropCaches()
+
+                    result = runMain(makeArgs(cand, ref, dst))
+                    record = dict(common)
+                    record.update(result)
+                    record.update({"mode" : name, "phase" : phase, "cachesDropped" : dropped})
+                    out.write(json.dumps(record, sort_keys=True) + "\n")
+
+                    print "{:<16} {:<5} {:>9.2f} {:>12} {:>10} {:>10}"\
+                          .format(name, phase, result["seconds"], result.get("bytesRead", "-"),\
+                                  result.get("readSyscalls", 0) + result.get("writeSyscalls", 0),\
+                                  result["maxRssKb"])
+                    if result["status"] != 0:
+                        print "  {} exited with status {}".format(name, result["status"])
+    finally:
+        if keep == None:
+            shutil.rmtree(tmpDir)
+
+## This function prints the wall time of each mode and run for every commit in
+#  a results file, in the order the commits were first measured
+def compare(path):
+    commits = []
+    seconds = dict()
+    with open(path) as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record["commit"] not in commits:
+                commits.append(record["commit"])
+            key = (record["mode"], record["phase"])
+            seconds.setdefault(key, dict()).setdefault(record["commit"], []).append(record["seconds"])
+
+    print "{:<22}".format("mode/run") + "".join("{:>12}".format(c[:10]) for c in commits)
+    for key in sorted(seconds.keys()):
+        row = "{:<22}".format("/".join(key))
+        for c in commits:
+            runs = seconds[key].get(c)
+            row += "{:>12}".format("{:.2f}".format(min(runs)) if runs else "-")
+        print row
+
+def main(argv):
+    params = {"files" : 2000, "minSize" : 1024, "maxSize" : 4 * 1024 * 1024,\
+              "depth" : 3, "fanout" : 4, "dupRatio" : 0.2, "seed" : 0}
+    jobs = 1
+    modes = None
+    outPath = "bench_results.jsonl"
+    keep = None
+    try:
+        opts, args = getopt.getopt(argv, "", ["files=", "sizes=", "depth=", "fanout=", "dup-ratio=",\
+                                              "seed=", "jobs=", "modes=", "out=", "keep=", "compare"])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == "--files":
+            params["files"] = int(arg)
+        elif opt == "--sizes":
+            params["minSize"], params["maxSize"] = [int(s) for s in arg.split(":")]
+        elif opt == "--depth":
+            params["depth"] = int(arg)
+        elif opt == "--fanout":
+            params["fanout"] = int(arg)
+        elif opt == "--dup-ratio":
+            params["dupRatio"] = float(arg)
+        elif opt == "--seed":
+            params["seed"] = int(arg)
+        elif opt == "--jobs":
+            jobs = int(arg)
+        elif opt == "--modes":
+            modes = arg.split(",")
+        elif opt == "--out":
+            outPath = arg
+        elif opt == "--keep":
+            keep = os.path.abspath(arg)
+        elif opt == "--compare":
+            if len(args) != 1:
+                printUsage()
+                sys.exit(2)
+            compare(args[0])
+            return
+
+    runSuite(params, modes, jobs, os.path.abspath(outPath), keep)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
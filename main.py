@@ -3,26 +3,88 @@
 import sys, getopt
 
 from Directory import *
+from Catalog import Catalog
+from Watcher import Watcher
+from Snapshot import Snapshot
+from Shard import Shard
 from Logger import Logger
+import Hasher
+import Stats
+import atexit
 import pprint
 
 def printUsage():
     print "Modes: "
-    print "fingerprint:         main.py --mode=fingerprint [-v -n --no-log] <dir>"
-    print "remove dups:         main.py --mode=remove-dups [-v -n --no-log] <dir> <refDir>"
+    print "fingerprint:         main.py --mode=fingerprint [-v -n --no-log --size-prefilter --jobs=N --skip-unchanged-dirs --upgrade-digests --io-order] <dir>"
+    print "                     main.py --mode=fingerprint [-v --no-log --jobs=N --index] --shards=N [--shard-by=<hash|top>] <dir>"
+    print "fingerprint a shard: main.py --mode=fingerprint-shard [-v --no-log --jobs=N] --shard=K/N [--shard-by=<hash|top>] <dir>"
+    print "merge shards:        main.py --mode=merge-shards [-v --no-log --jobs=N --index] <dir>"
+    print "remove dups:         main.py --mode=remove-dups [-v -n --no-log --hash-on-demand] <dir> <refDir>"
+    print "                     main.py --mode=remove-dups [-v -n --no-log --require-all] --catalog=<file> <dir>"
+    print "                     main.py --mode=remove-dups [-v -n --no-log] --snapshot=<file> <dir>"
+    print "                     main.py --mode=remove-dups [-v --no-log] --plan=<file>"
+    print "undo remove dups:    main.py --mode=undo-remove-dups [-v --no-log] --plan=<file>"
+    print "reverse remove dups: main.py --mode=reverse-remove-dups [-v --no-log] --plan=<file>"
+    print "watch:               main.py --mode=watch [-v --no-log --jobs=N --debounce=<seconds> --poll=<seconds>] <dir>"
     print "check internal dups: main.py --mode=check-int-dups [-v -n --no-log] <dir>"
-    print "copy unique files:   main.py --mode=copy-uniq-files [-v --no-log] <dir> <refDir> <dst>"
+    print "check dup dirs:      main.py --mode=check-dup-dirs [-v --no-log] <dir>"
+    print "link internal dups:  main.py --mode=link-int-dups [-v -n --no-log --link=<hardlink|reflink> --verify] <dir>"
+    print "copy unique files:   main.py --mode=copy-uniq-files [-v --no-log --jobs=N] <dir> <refDir> <dst>"
+    print "                     main.py --mode=copy-uniq-files [-v --no-log --jobs=N --require-all] --catalog=<file> <dir> <dst>"
+    print "                     main.py --mode=copy-uniq-files [-v --no-log --jobs=N] --snapshot=<file> <dir> <dst>"
+    print "update catalog:      main.py --mode=catalog [-v --no-log] --catalog=<file> [<refDir> ...]"
+    print "import to index:     main.py --mode=import-index [-v --no-log] <dir>"
+    print "export from index:   main.py --mode=export-index [-v --no-log] <dir>"
+    print "export snapshot:     main.py --mode=export-snapshot [-v --no-log] --snapshot=<file> <dir>"
+    print "import snapshot:     main.py --mode=import-snapshot [-v --no-log] --snapshot=<file> <dir>"
+    print ""
+    print "--index: keep the fingerprints of the tree in a single index. an existing index is always used."
+    print "--run-log=<file>: write the logs of all directories to a single file"
+    print "--snapshot=<file>: with fingerprint mode, keep the fingerprints of the tree in a single snapshot file"
+    print "--shard-by=<hash|top>: split the tree into shards by directory path (default) or by top level directory"
+    print "--plan=<file>: plan written by remove-dups, see .dp/plans of the candidate directory"
+    print "--hash=<md5|sha1|blake2b>: digest algorithm for new digests (default: md5)"
+    print "--read-size=<bytes>: size of each read when hashing"
+    print "--stats=<text|json>: print counters and timers of the run when it ends"
+    print "--progress=<seconds>: print a progress line to stderr every <seconds>"
 
 def main(argv):
     dryRun = False
+    sizePrefilter = False
+    jobs = 1
+    useIndex = None
+    skipUnchanged = False
+    upgradeDigests = False
+    onDemand = False
+    catalogPath = None
+    snapshotPath = None
+    planPath = None
+    shards = None
+    shard = None
+    shardBy = "hash"
+    # options passed on to the workers of a sharded fingerprint
+    workerArgs = []
+    requireAll = False
+    linkMethod = "hardlink"
+    verify = False
+    ioOrder = False
+    debounce = 2.0
+    pollInterval = None
     mode = None
     try:
-        opts, args = getopt.getopt(argv,"vn",["no-log","mode="])
+        opts, args = getopt.getopt(argv,"vn",["no-log","mode=","size-prefilter","jobs=","index","run-log=","skip-unchanged-dirs",\
+                                                "hash=","read-size=","upgrade-digests",\
+                                                "stats=","progress=","hash-on-demand",\
+                                                "catalog=","require-all","link=","verify",\
+                                                "debounce=","poll=","io-order","snapshot=","plan=","shards=","shard=","shard-by="])
     except getopt.GetoptError:
         printUsage()
         sys.exit(2)
 
     for opt, arg in opts:
+        if opt in ('-v', '--no-log', '--hash', '--read-size', '--stats', '--progress'):
+            workerArgs.append(opt + "=" + arg if arg else opt)
+
         if opt == '-v':
             print "verbose logging enabled"
             Logger.setLogLevel(Logger.Level.Debug)
@@ -35,6 +97,57 @@ def main(argv):
             Logger.logToStdOut()
         elif opt == "--mode":
             mode = arg
+        elif opt == "--size-prefilter":
+            sizePrefilter = True
+        elif opt == "--jobs":
+            jobs = int(arg)
+        elif opt == "--index":
+            useIndex = True
+        elif opt == "--run-log":
+            Logger.logToRunLog(arg)
+        elif opt == "--skip-unchanged-dirs":
+            skipUnchanged = True
+        elif opt == "--hash":
+            Hasher.configure(algo=arg)
+        elif opt == "--read-size":
+            Hasher.configure(bufSize=int(arg))
+        elif opt == "--upgrade-digests":
+            upgradeDigests = True
+        elif opt == "--stats":
+            if arg not in ("text", "json"):
+                printUsage()
+                sys.exit(2)
+            # registered before the log writer, so the report is printed
+            # after the last log message
+            atexit.register(Stats.report, arg)
+        elif opt == "--progress":
+            Stats.progressInterval = float(arg)
+        elif opt == "--hash-on-demand":
+            onDemand = True
+        elif opt == "--catalog":
+            catalogPath = arg
+        elif opt == "--require-all":
+            requireAll = True
+        elif opt == "--link":
+            linkMethod = arg
+        elif opt == "--verify":
+            verify = True
+        elif opt == "--snapshot":
+            snapshotPath = arg
+        elif opt == "--shards":
+            shards = int(arg)
+        elif opt == "--shard":
+            shard = [int(n) for n in arg.split("/")]
+        elif opt == "--shard-by":
+            shardBy = arg
+        elif opt == "--plan":
+            planPath = arg
+        elif opt == "--io-order":
+            ioOrder = True
+        elif opt == "--debounce":
+            debounce = float(arg)
+        elif opt == "--poll":
+            pollInterval = float(arg)
         else:
             printUsage()
             sys.exit(2)
@@ -43,7 +156,50 @@ def main(argv):
     # enable debug logging till we have some confidence in the implementation
     # Logger.setLogLevel(Logger.Level.Debug)
 
-    if 'fingerprint' == mode or 'check-int-dups' == mode:
+    # a snapshot is the only file a tree fingerprinted into it gets, so its
+    # logs go next to it
+    if mode == 'fingerprint' and snapshotPath != None\
+            and Logger.runLogFile == None and not Logger.toStdOut:
+        Logger.logToRunLog(snapshotPath + ".log")
+
+    # write logs from a background thread in batches
+    Logger.startWriter()
+
+    if mode == 'fingerprint' and snapshotPath != None:
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            print "specify directory to fingerprint"
+            printUsage()
+            sys.exit(2)
+
+        Snapshot.fingerPrint(args[0], snapshotPath, dryRun, sizePrefilter, jobs, skipUnchanged,\
+                             upgradeDigests, ioOrder)
+
+    elif mode == 'fingerprint' and shards != None:
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            print "specify directory to fingerprint"
+            printUsage()
+            sys.exit(2)
+        if dryRun or sizePrefilter or skipUnchanged or upgradeDigests or ioOrder:
+            raise Exception("a sharded fingerprint only supports --jobs and --index")
+
+        Shard.run(args[0], shards, shardBy, workerArgs, useIndex, jobs)
+
+    elif mode == 'fingerprint-shard' or mode == 'merge-shards':
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            print "specify the root directory of the tree"
+            printUsage()
+            sys.exit(2)
+
+        if mode == 'merge-shards':
+            Shard.merge(args[0], None, useIndex, jobs)
+        elif shard == None or len(shard) != 2:
+            print "specify the shard as --shard=K/N"
+            printUsage()
+            sys.exit(2)
+        else:
+            Shard(args[0], shard[0], shard[1], shardBy).fingerPrint(jobs)
+
+    elif mode in ('fingerprint', 'check-int-dups', 'check-dup-dirs', 'link-int-dups'):
         if len(args) != 1:
             print "specify directory to fingerprint"
             printUsage()
@@ -54,12 +210,54 @@ def main(argv):
             printUsage()
             sys.exit(2)
 
-        dir = Directory(args[0])
+        dir = Directory(args[0], useIndex=useIndex)
         if 'fingerprint' == mode:
-            dir.fingerPrint(dryRun)
+            dir.fingerPrint(dryRun, sizePrefilter, jobs, skipUnchanged, upgradeDigests, ioOrder)
+        elif 'check-dup-dirs' == mode:
+            dir.checkForDupDirs()
+        elif 'link-int-dups' == mode:
+            dir.linkInternalDups(linkMethod, verify, dryRun)
         else:
             dir.checkForInternalDups()
 
+    elif mode == 'watch':
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            print "specify directory to watch"
+            printUsage()
+            sys.exit(2)
+
+        try:
+            Watcher(args[0], jobs, debounce, pollInterval, useIndex).run()
+        except KeyboardInterrupt:
+            print "stopped watching {}".format(args[0])
+
+    elif mode in ('remove-dups', 'undo-remove-dups', 'reverse-remove-dups') and planPath != None:
+        if args or not os.path.isfile(planPath):
+            print "specify an existing plan and no directories"
+            printUsage()
+            sys.exit(2)
+
+        if mode == 'remove-dups':
+            Directory.executeRemoveDups(planPath)
+        elif mode == 'undo-remove-dups':
+            Directory.undoRemoveDups(planPath)
+        else:
+            Directory.reverseRemoveDups(planPath)
+
+    elif mode == 'remove-dups' and (catalogPath != None or snapshotPath != None):
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            print "specify candidate directory"
+            printUsage()
+            sys.exit(2)
+        if onDemand:
+            raise Exception("--hash-on-demand needs a reference directory, not a catalog or snapshot")
+
+        cDir = Directory(args[0], useIndex=useIndex)
+        if catalogPath != None:
+            cDir.removeDups(Catalog(catalogPath, requireAll), dryRun)
+        else:
+            cDir.removeDups(Snapshot(snapshotPath), dryRun)
+
     elif mode == 'remove-dups':
         if len(args) != 2:
             print "specify candidate and reference directories"
@@ -71,30 +269,82 @@ def main(argv):
             printUsage()
             sys.exit(2)
 
-        cDir = Directory(args[0])
+        cDir = Directory(args[0], useIndex=useIndex)
         refDir = Directory(args[1], True)
-        cDir.removeDups(refDir, dryRun)
+        cDir.removeDups(refDir, dryRun, onDemand)
 
     elif mode == 'copy-uniq-files':
         if dryRun:
             raise Exception("dry run is not supported in this mode")
 
-        if len(args) != 3:
-            print "specify candidate, reference and destination directories"
-            printUsage()
-            sys.exit(2)
+        if catalogPath != None or snapshotPath != None:
+            if len(args) != 2:
+                print "specify candidate and destination directories"
+                printUsage()
+                sys.exit(2)
+            if catalogPath != None:
+                refDir = Catalog(catalogPath, requireAll)
+            else:
+                refDir = Snapshot(snapshotPath)
+            dstPath = args[1]
+        else:
+            if len(args) != 3:
+                print "specify candidate, reference and destination directories"
+                printUsage()
+                sys.exit(2)
+            refDir = Directory(os.path.abspath(args[1]))
+            dstPath = args[2]
 
-        cDir = Directory(os.path.abspath(args[0]))
-        refDir = Directory(os.path.abspath(args[1]))
-        if not os.path.isdir(os.path.abspath(args[2])):
+        cDir = Directory(os.path.abspath(args[0]), useIndex=useIndex)
+        if not os.path.isdir(os.path.abspath(dstPath)):
             raise Exception("destination directory does not exist")
 
-        dPath = os.path.join(os.path.join(os.path.abspath(args[2]), cDir.dirName))
+        dPath = os.path.join(os.path.join(os.path.abspath(dstPath), cDir.dirName))
         if not os.path.isdir(dPath):
             os.makedirs(dPath)
 
         dst = Directory(dPath)
-        cDir.copyUniques(refDir, dst)
+        cDir.copyUniques(refDir, dst, jobs)
+
+    elif mode == 'import-snapshot' or mode == 'export-snapshot':
+        if len(args) != 1 or not os.path.isdir(args[0]) or snapshotPath == None:
+            print "specify the snapshot file and the root directory of the tree"
+            printUsage()
+            sys.exit(2)
+
+        if mode == 'export-snapshot':
+            Snapshot.export(Directory(args[0], useIndex=useIndex), snapshotPath)
+        else:
+            snapshot = Snapshot(snapshotPath)
+            snapshot.importTo(Directory(args[0], useIndex=useIndex))
+            snapshot.close()
+
+    elif mode == 'import-index' or mode == 'export-index':
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            print "specify the root directory of the tree"
+            printUsage()
+            sys.exit(2)
+
+        if mode == 'import-index':
+            Directory(args[0], useIndex=False).importToIndex()
+        else:
+            Directory(args[0], useIndex=True).exportFromIndex()
+
+    elif mode == 'catalog':
+        if catalogPath == None:
+            print "specify the catalog file"
+            printUsage()
+            sys.exit(2)
+
+        catalog = Catalog(catalogPath)
+        if args:
+            for root in args:
+                if not os.path.isdir(root):
+                    raise Exception(root + " does not exist or is not a directory")
+                catalog.updateTarget(root)
+        else:
+            catalog.updateAll()
+        catalog.close()
 
     else:
         print "invalid mode"